@@ -0,0 +1,88 @@
+from typing import Optional
+
+import numpy as np
+
+
+# 0〜255の各バイト値に立っているビット数 (popcount) の表
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+class BinarySignIndex:
+    """
+    各次元の符号だけを1ビットに詰めたバイナリコードによる前段フィルタ
+    1536次元なら1件192バイト (float32の1/32) で、ハミング距離の小さい行を候補として返す
+    """
+    def __init__(self, n_candidates: int = 1000):
+        self.n_candidates = n_candidates   # 元のベクトルで再スコアリングする候補数
+        self._codes = []                   # (件数, ceil(次元/8)) uint8 のコード (追加バッチ単位の配列)
+
+    @staticmethod
+    def encode(vectors: np.ndarray) -> np.ndarray:
+        return np.packbits(np.asarray(vectors) > 0, axis=-1)
+
+    def add(self, vectors: np.ndarray):
+        """ベクトルを符号化して末尾に追加"""
+        self._codes.append(self.encode(vectors))
+
+    @property
+    def codes(self) -> np.ndarray:
+        """登録済みのコード"""
+        if not self._codes:
+            return np.empty((0, 0), dtype=np.uint8)
+        if len(self._codes) > 1:
+            self._codes = [np.concatenate(self._codes)]
+        return self._codes[0]
+
+    @codes.setter
+    def codes(self, codes: np.ndarray):
+        self._codes = [np.asarray(codes, dtype=np.uint8)]
+
+    def hamming_distances(
+        self,
+        query_vector: np.ndarray,
+        indices: Optional[np.ndarray] = None,
+        block_size: int = 65536
+    ) -> np.ndarray:
+        """クエリのコードと登録済みの行 (indices指定時はその行のみ) とのハミング距離"""
+        query_code = self.encode(query_vector)
+        codes = self.codes if indices is None else self.codes[indices]
+        distances = np.empty(len(codes), dtype=np.uint16)
+        for start in range(0, len(codes), block_size):
+            block = np.bitwise_xor(codes[start:start + block_size], query_code)
+            distances[start:start + len(block)] = _POPCOUNT_TABLE[block].sum(axis=1, dtype=np.uint16)
+        return distances
+
+    def candidates(
+        self,
+        query_vector: np.ndarray,
+        n_candidates: Optional[int] = None,
+        indices: Optional[np.ndarray] = None,
+        allowed: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        ハミング距離が小さい順に最大n_candidates件の行番号を返す
+        allowed (行ごとのbool配列) を指定した場合は、Trueの行 (削除されていない行など) だけから選ぶ
+        """
+        distances = self.hamming_distances(query_vector, indices)
+        n_available = len(distances)
+        if allowed is not None:
+            allowed = allowed if indices is None else allowed[indices]
+            distances[~allowed] = np.iinfo(distances.dtype).max
+            n_available = int(np.count_nonzero(allowed))
+        n_candidates = min(n_candidates or self.n_candidates, n_available)
+        if n_candidates <= 0:
+            return np.empty(0, dtype=np.intp)
+        top = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+        return np.sort(top if indices is None else indices[top])
+
+    def save(self, f):
+        """コードをnpz形式で書き出す"""
+        np.savez(f, codes=self.codes, n_candidates=np.array(self.n_candidates))
+
+    @classmethod
+    def load(cls, f) -> "BinarySignIndex":
+        """saveで書き出したコードを読み込む"""
+        with np.load(f) as data:
+            index = cls(n_candidates=int(data["n_candidates"]))
+            index.codes = data["codes"]
+        return index
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+from openai import AzureOpenAI
+
+from rate_limiter import RateLimiter, estimate_tokens
+from ingestion import decode_embeddings
+
+
+class AzureOpenAIEmbedder:
+    """Azure OpenAIを使用して埋め込みを生成するクラス"""
+    def __init__(self, client=None, model=None, timeout=60, cache=None, rate_limiter=None):
+        """
+        cache (EmbeddingCache) を指定した場合は、キャッシュにないテキストだけをAPIに送る
+        rate_limiterを省略した場合は、デプロイメントごとにプロセスで共有するRateLimiterを使う
+        (上限は環境変数 AZURE_OPENAI_RPM / AZURE_OPENAI_TPM で指定)
+        """
+        self.client = client or AzureOpenAI(
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
+        )
+        self.model = model or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter or RateLimiter.shared(
+            self.model,
+            requests_per_minute=int(os.getenv("AZURE_OPENAI_RPM", 0)) or None,
+            tokens_per_minute=int(os.getenv("AZURE_OPENAI_TPM", 0)) or None
+        )
+
+    def _create_embeddings(self, texts, tokens=None):
+        """
+        APIで埋め込みを生成し、float32の行列 (テキスト数, 次元数) で返す
+        流量制限と、429・一時的なエラーの再試行はRateLimiterが行う (失敗の報告は呼び出し元で行う)
+        tokens (合計トークン数) を省略した場合はここで見積もる
+        """
+        # クライアント自身の再試行は無効にして、429をRateLimiterに伝える
+        client = self.client.with_options(max_retries=0)
+        response = self.rate_limiter.call(
+            lambda: client.embeddings.with_raw_response.create(
+                model=self.model,
+                input=texts,
+                encoding_format="base64",
+                timeout=self.timeout
+            ),
+            tokens=estimate_tokens(texts) if tokens is None else tokens
+        )
+        return decode_embeddings(response.parse().data)
+
+    def embed_documents(self, texts, tokens=None):
+        """
+        テキストの配列を埋め込みベクトルに変換し、float32の行列で返す
+        tokens (テキストごとのトークン数) を渡した場合は、RateLimiter用に数え直さない
+        """
+        if self.cache is None:
+            return self._create_embeddings(texts, sum(tokens) if tokens is not None else None)
+
+        embeddings = self.cache.get_many(self.model, texts)
+        # キャッシュにないテキストだけを、重複を除いてAPIに送る
+        misses = list(dict.fromkeys(text for text, e in zip(texts, embeddings) if e is None))
+        if misses:
+            if tokens is not None:
+                counts = dict(zip(texts, tokens))
+                created = self._create_embeddings(misses, sum(counts[text] for text in misses))
+            else:
+                created = self._create_embeddings(misses)
+            self.cache.put_many(self.model, misses, created)
+            created = dict(zip(misses, created))
+            embeddings = [created[text] if e is None else e for text, e in zip(texts, embeddings)]
+        return np.stack(embeddings) if embeddings else np.empty((0, 0), dtype=np.float32)
+
+    def embed_query(self, text):
+        """単一のクエリテキストを埋め込みベクトルに変換"""
+        return self.embed_documents([text])[0]
@@ -0,0 +1,69 @@
+import hashlib
+import sqlite3
+import threading
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    埋め込みベクトルのディスクキャッシュ
+    (モデル名, テキストのsha256) をキーにfloat32のベクトルをSQLiteへ保存し、
+    同じテキストを再度取り込むときにAPIを呼ばずに済むようにする
+    """
+    def __init__(self, path: str = "embedding_cache.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        ''')
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def get_many(self, model: str, texts: Sequence[str], chunk_size: int = 500) -> List[Optional[np.ndarray]]:
+        """textsと同じ順序でキャッシュ済みのベクトルを返す (未登録のテキストはNone)"""
+        hashes = [self.text_hash(text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), chunk_size):
+                chunk = hashes[start:start + chunk_size]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._conn.execute(
+                    f'SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})',
+                    [model, *chunk]
+                ).fetchall())
+        return [
+            np.frombuffer(found[h], dtype=np.float32) if h in found else None
+            for h in hashes
+        ]
+
+    def put_many(self, model: str, texts: Sequence[str], vectors):
+        """テキストとベクトルの組をキャッシュに保存 (既存のキーは上書き)"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)',
+                [(model, self.text_hash(text), vector.tobytes()) for text, vector in zip(texts, vectors)]
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,32 +1,362 @@
-from pathlib import Path
 import numpy as np
 import json
 import os
 import pickle
+import uuid
 from typing import List, Dict, Tuple, Optional, Union
 from openai import AzureOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
-import time
+from collections import Counter
 from datetime import datetime
+from hnsw_index import HNSWIndex
+from binary_index import BinarySignIndex
+from vector_storage import VectorStoreBase, replace_atomically, save_optional
+from embedding_cache import EmbeddingCache
+from embedder import AzureOpenAIEmbedder
+from ingestion import read_markdown_files, run_pipeline
 
-class EnhancedVectorStore:
-    def __init__(self):
-        self.vectors = []        # 埋め込みベクトルを保存
-        self.texts = []          # 元のテキストを保存
-        self.metadatas = []      # メタデータを保存
-        self.source_stats = {}   # ソースタイプごとの統計情報
+class IVFIndex:
+    """
+    k-meansの粗量子化器による転置ファイル (IVF) 近似検索インデックス
+    各行を最も近いセントロイドのリストに登録し、検索時はクエリに近いnprobe個のリストだけを走査する
+    """
+    def __init__(self, nlist: int, nprobe: int = 8, n_iter: int = 20, seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None                          # (nlist, dim) 正規化済みセントロイド
+        self._lists = [[] for _ in range(nlist)]       # リストごとの行番号 (追加バッチ単位の配列)
+        self._assignments = []                         # 行ごとの所属リスト (追加バッチ単位の配列)
+
+    def train(self, sample: np.ndarray):
+        """正規化済みのサンプルベクトルで球面k-meansを学習"""
+        rng = np.random.default_rng(self.seed)
+        if len(sample) < self.nlist:
+            raise ValueError(f"学習サンプル数 ({len(sample)}) が nlist ({self.nlist}) より少ないです")
+
+        centroids = sample[rng.choice(len(sample), self.nlist, replace=False)].copy()
+        for _ in range(self.n_iter):
+            assignments = self.assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=self.nlist)
+
+            # 空になったクラスタはランダムなサンプルで再初期化
+            empty = np.flatnonzero(counts == 0)
+            if len(empty):
+                sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        self.centroids = centroids
+        self.reset()
+
+    def reset(self):
+        """セントロイドは保持したまま、登録済みの行をすべて消去"""
+        self._lists = [[] for _ in range(self.nlist)]
+        self._assignments = []
+
+    @staticmethod
+    def assign(vectors: np.ndarray, centroids: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        """各ベクトルを内積最大のセントロイドに割り当てる"""
+        assignments = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            assignments[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    def add(self, vectors: np.ndarray, start_row: int):
+        """正規化済みベクトルを行番号start_rowから順に登録"""
+        self.add_assignments(self.assign(vectors, self.centroids), start_row)
+
+    def add_assignments(self, assignments: np.ndarray, start_row: int):
+        """計算済みの所属リストを使って行を登録"""
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=self.nlist)
+        groups = np.split(order.astype(np.int64) + start_row, np.cumsum(counts)[:-1])
+        for list_id in np.flatnonzero(counts):
+            self._lists[list_id].append(groups[list_id])
+        self._assignments.append(np.asarray(assignments, dtype=np.int32))
+
+    def _list_rows(self, list_id: int) -> np.ndarray:
+        """リストに登録された行番号を1つの配列にまとめて返す"""
+        chunks = self._lists[list_id]
+        if len(chunks) > 1:
+            self._lists[list_id] = [np.concatenate(chunks)]
+        return self._lists[list_id][0] if chunks else np.empty(0, dtype=np.int64)
+
+    def candidates(self, query_vector: np.ndarray, nprobe: Optional[int] = None) -> np.ndarray:
+        """クエリに近いnprobe個のリストに登録された行番号を返す"""
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        probe = np.argpartition(-(self.centroids @ query_vector), nprobe - 1)[:nprobe]
+        return np.concatenate([self._list_rows(list_id) for list_id in probe])
+
+    @property
+    def assignments(self) -> np.ndarray:
+        """行ごとの所属リスト"""
+        if not self._assignments:
+            return np.empty(0, dtype=np.int32)
+        if len(self._assignments) > 1:
+            self._assignments = [np.concatenate(self._assignments)]
+        return self._assignments[0]
+
+class ProductQuantizer:
+    """
+    直積量子化 (PQ) による圧縮インデックス
+    ベクトルをm個の部分空間に分割し、部分空間ごとに学習したコードブック (最大256個) の番号
+    (uint8) だけを保持する。検索時はクエリと各セントロイドの内積表を引いて類似度を近似する (ADC)
+    """
+    def __init__(self, m: int, n_iter: int = 20, rerank_k: int = 100, seed: int = 0):
+        self.m = m                     # 部分空間の数 (= 1ベクトルあたりのバイト数)
+        self.n_iter = n_iter
+        self.rerank_k = rerank_k       # 元のベクトルで再スコアリングする候補数 (0で無効)
+        self.seed = seed
+        self.codebooks = None          # (m, ksub, dsub) 部分空間ごとのセントロイド
+        self._codes = []               # (件数, m) uint8 のコード (追加バッチ単位の配列)
+
+    def train(self, sample: np.ndarray):
+        """部分空間ごとにk-meansでコードブックを学習"""
+        dim = sample.shape[1]
+        if dim % self.m != 0:
+            raise ValueError(f"次元 ({dim}) が部分空間の数 m ({self.m}) で割り切れません")
+
+        rng = np.random.default_rng(self.seed)
+        ksub = min(256, len(sample))
+        subvectors = sample.reshape(len(sample), self.m, dim // self.m)
+        codebooks = np.empty((self.m, ksub, dim // self.m), dtype=np.float32)
+
+        for j in range(self.m):
+            x = np.ascontiguousarray(subvectors[:, j])
+            centroids = x[rng.choice(len(x), ksub, replace=False)].copy()
+            for _ in range(self.n_iter):
+                assignments = self._nearest(x, centroids)
+                sums = np.zeros_like(centroids)
+                np.add.at(sums, assignments, x)
+                counts = np.bincount(assignments, minlength=ksub)
+
+                # 空になったクラスタはランダムなサンプルで再初期化
+                empty = counts == 0
+                sums[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+                counts[empty] = 1
+                centroids = sums / counts[:, None]
+            codebooks[j] = centroids
+
+        self.codebooks = codebooks
+        self._codes = []
+
+    @staticmethod
+    def _nearest(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """ユークリッド距離が最小のセントロイド番号を返す"""
+        distances = (centroids ** 2).sum(axis=1) - 2 * (x @ centroids.T)
+        return np.argmin(distances, axis=1)
+
+    def encode(self, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """ベクトルを (件数, m) のuint8コードに変換"""
+        dsub = self.codebooks.shape[2]
+        codes = np.empty((len(vectors), self.m), dtype=np.uint8)
+        for start in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            block = block.reshape(len(block), self.m, dsub)
+            for j in range(self.m):
+                codes[start:start + len(block), j] = self._nearest(block[:, j], self.codebooks[j])
+        return codes
+
+    def add(self, vectors: np.ndarray):
+        """ベクトルを符号化して末尾に追加"""
+        self._codes.append(self.encode(vectors))
+
+    @property
+    def codes(self) -> np.ndarray:
+        """登録済みのコード"""
+        if not self._codes:
+            return np.empty((0, self.m), dtype=np.uint8)
+        if len(self._codes) > 1:
+            self._codes = [np.concatenate(self._codes)]
+        return self._codes[0]
+
+    @codes.setter
+    def codes(self, codes: np.ndarray):
+        self._codes = [np.asarray(codes, dtype=np.uint8)]
+
+    def lookup_tables(self, query_vector: np.ndarray) -> np.ndarray:
+        """クエリの各部分ベクトルと全セントロイドとの内積表 (m, ksub) を作成"""
+        query = query_vector.reshape(self.m, -1)
+        return np.einsum('jd,jkd->jk', query, self.codebooks)
+
+    def approximate_scores(self, query_vector: np.ndarray, indices: Optional[np.ndarray] = None) -> np.ndarray:
+        """正規化済みクエリと登録済みの行 (indices指定時はその行のみ) の近似類似度"""
+        codes = self.codes if indices is None else self.codes[indices]
+        return self.score(self.lookup_tables(query_vector), codes)
+
+    def score(self, tables: np.ndarray, codes: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """内積表を引いて、コード化されたベクトルとクエリの内積を近似"""
+        scores = np.empty(len(codes), dtype=np.float32)
+        subspaces = np.arange(self.m)
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size]
+            scores[start:start + len(block)] = tables[subspaces, block].sum(axis=1)
+        return scores
+
+class ScalarQuantizer:
+    """
+    スカラー量子化による軽量な圧縮インデックス
+    float16はそのまま半精度に、int8は固定のスケール (1/127) で [-127, 127] に丸めて保持する
+    行は正規化済みで各成分は[-1, 1]に収まるため、学習は不要で後から追加した行も切り詰められない
+    """
+    DTYPES = {"float16": np.float16, "int8": np.int8}
+    INT8_SCALE = np.float32(1 / 127)
+
+    def __init__(self, dtype: str = "int8", rerank_k: int = 100):
+        if dtype not in self.DTYPES:
+            raise ValueError(f"未対応の量子化形式です: {dtype}")
+        self.dtype = dtype
+        self.rerank_k = rerank_k       # 元のベクトルで再スコアリングする候補数 (0で無効)
+        # int8のスケール (古い形式で保存したインデックスは次元ごとのスケールを読み込む)
+        self.scale = self.INT8_SCALE if dtype == "int8" else None
+        self._codes = []               # 量子化済みベクトル (追加バッチ単位の配列)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dtype == "float16":
+            return vectors.astype(np.float16)
+        return np.clip(np.rint(vectors / self.scale), -127, 127).astype(np.int8)
+
+    def add(self, vectors: np.ndarray):
+        """ベクトルを量子化して末尾に追加"""
+        self._codes.append(self.encode(vectors))
+
+    @property
+    def codes(self) -> np.ndarray:
+        """登録済みの量子化ベクトル"""
+        if not self._codes:
+            return np.empty((0, 0), dtype=self.DTYPES[self.dtype])
+        if len(self._codes) > 1:
+            self._codes = [np.concatenate(self._codes)]
+        return self._codes[0]
+
+    @codes.setter
+    def codes(self, codes: np.ndarray):
+        self._codes = [np.asarray(codes, dtype=self.DTYPES[self.dtype])]
+
+    def approximate_scores(
+        self,
+        query_vector: np.ndarray,
+        indices: Optional[np.ndarray] = None,
+        block_size: int = 65536
+    ) -> np.ndarray:
+        """
+        正規化済みクエリと登録済みの行 (indices指定時はその行のみ) の近似類似度
+        int8ではスケールをクエリ側に掛けておき、量子化値との内積をそのまま計算する
+        """
+        codes = self.codes if indices is None else self.codes[indices]
+        query = query_vector if self.scale is None else query_vector * self.scale
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), block_size):
+            block = codes[start:start + block_size]
+            scores[start:start + len(block)] = block.astype(np.float32) @ query
+        return scores
+
+class _ColumnIndex:
+    """
+    メタデータの1項目を整数コードの列として保持する
+    値ごとの行番号 (ポスティング) は最初の検索時に作成し、以降は追加分だけを末尾に足す
+    """
+    def __init__(self, values: Optional[List] = None, codes: Optional[np.ndarray] = None):
+        self.values = list(values or [])                           # コード -> 値
+        self._code_of = {value: code for code, value in enumerate(self.values)}
+        self._codes = [np.asarray(codes, dtype=np.int32)] if codes is not None else []
+        self._postings = None   # コードごとの行番号 (追加バッチ単位の配列のリスト)
+
+    def _code(self, value) -> int:
+        code = self._code_of.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._code_of[value] = code
+            if self._postings is not None:
+                self._postings.append([])
+        return code
+
+    def add(self, values: List, start_row: int):
+        """値の列を行番号start_rowから順に追加"""
+        codes = np.fromiter((self._code(value) for value in values), dtype=np.int32, count=len(values))
+        self._codes.append(codes)
+        if self._postings is not None:
+            self._add_postings(codes, start_row)
+
+    def _add_postings(self, codes: np.ndarray, start_row: int):
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes, minlength=len(self.values))
+        groups = np.split(order.astype(np.int64) + start_row, np.cumsum(counts)[:-1])
+        for code in np.flatnonzero(counts):
+            self._postings[code].append(groups[code])
+
+    @property
+    def codes(self) -> np.ndarray:
+        """行ごとのコード"""
+        if not self._codes:
+            return np.empty(0, dtype=np.int32)
+        if len(self._codes) > 1:
+            self._codes = [np.concatenate(self._codes)]
+        return self._codes[0]
+
+    def rows(self, values: List) -> np.ndarray:
+        """いずれかの値に一致する行番号を昇順で返す"""
+        if self._postings is None:
+            self._postings = [[] for _ in self.values]
+            self._add_postings(self.codes, 0)
+
+        arrays = []
+        for value in values:
+            code = self._code_of.get(value)
+            if code is None or not self._postings[code]:
+                continue
+            if len(self._postings[code]) > 1:
+                self._postings[code] = [np.concatenate(self._postings[code])]
+            arrays.append(self._postings[code][0])
+
+        if not arrays:
+            return np.empty(0, dtype=np.int64)
+        return arrays[0] if len(arrays) == 1 else np.sort(np.concatenate(arrays))
+
+    def subset(self, rows: np.ndarray):
+        """指定した行だけを残す (ポスティングは次の検索時に作り直す)"""
+        self._codes = [self.codes[rows]]
+        self._postings = None
+
+class EnhancedVectorStore(VectorStoreBase):
+    # 整数コードの列として保持し、検索時のフィルタに使えるメタデータ項目
+    FILTER_COLUMNS = ("source_type", "original_format", "source")
+
+    def __init__(self, initial_capacity: int = 1024, compaction_threshold: float = 0.3):
+        super().__init__(initial_capacity, compaction_threshold)
+        self.source_stats = {}   # ソースタイプごとの統計情報 (get_statsの結果)
+        self._stats = {}         # 追加・削除のたびに差分で更新する統計情報
+        self.ivf_index = None    # IVF近似検索インデックス (build_ivf_indexで作成)
+        self.hnsw_index = None   # HNSWグラフインデックス (build_hnsw_indexで作成)
+        self.pq_index = None     # 直積量子化インデックス (build_pq_indexで作成)
+        self.sq_index = None     # スカラー量子化インデックス (build_sq_indexで作成)
+        self.binary_index = None # バイナリコードの前段フィルタ (build_binary_indexで作成)
+        self._columns = {name: _ColumnIndex() for name in self.FILTER_COLUMNS}
 
     def add_vectors(
         self, 
-        vectors: List[List[float]], 
+        vectors: Union[np.ndarray, List[List[float]]], 
         texts: List[str], 
         metadatas: Optional[List[Dict]] = None,
         source_type: str = None,
         original_format: str = None
-    ):
-        """ベクトル、テキスト、メタデータを追加"""
+    ) -> List[int]:
+        """
+        ベクトル、テキスト、メタデータを追加し、追加したドキュメントのIDを返す
+        vectorsがfloat32のndarrayの場合はコピーせず、正規化した結果を行列に直接書き込む
+        """
         if not metadatas:
             metadatas = [{} for _ in texts]
+        if len(texts) == 0:
+            return []
 
         # メタデータの拡張
         for metadata in metadatas:
@@ -36,139 +366,628 @@ class EnhancedVectorStore:
                 metadata["original_format"] = original_format
             metadata["added_at"] = datetime.now().isoformat()
 
-        self.vectors.extend(vectors)
-        self.texts.extend(texts)
-        self.metadatas.extend(metadatas)
-        self._update_stats()
+        start_row, ids = self._append_rows(vectors, texts, metadatas)
+        for name, column in self._columns.items():
+            column.add([metadata.get(name) for metadata in metadatas], start_row)
+        if self.ivf_index is not None:
+            self.ivf_index.add(self._matrix[start_row:self._size], start_row)
+        if self.hnsw_index is not None:
+            self.hnsw_index.add_items(self.vectors, start_row, self._size)
+        if self.pq_index is not None:
+            self.pq_index.add(self._matrix[start_row:self._size])
+        if self.sq_index is not None:
+            self.sq_index.add(self._matrix[start_row:self._size])
+        if self.binary_index is not None:
+            self.binary_index.add(self._matrix[start_row:self._size])
+        self._add_stats(metadatas)
+        return ids.tolist()
+
+    def _rebuild_columns(self):
+        """メタデータを走査してフィルタ用の列を作り直す (列を保存していない旧形式の読み込み用)"""
+        self._columns = {name: _ColumnIndex() for name in self.FILTER_COLUMNS}
+        metadatas = list(self.metadatas)
+        for name, column in self._columns.items():
+            column.add([metadata.get(name) for metadata in metadatas], 0)
+
+    def _filter_indices(
+        self,
+        source_type: Optional[Union[str, List[str]]] = None,
+        filter: Optional[Dict[str, Union[str, List[str]]]] = None
+    ) -> Optional[np.ndarray]:
+        """
+        フィルタ条件に一致する行番号を昇順で返す (フィルタなしの場合はNone)
+        filterは {項目名: 値 または 値のリスト} で、FILTER_COLUMNSの項目を指定できる
+        """
+        conditions = dict(filter or {})
+        if source_type:
+            conditions["source_type"] = source_type
+        if not conditions:
+            return None
+
+        indices = None
+        for name, values in conditions.items():
+            if name not in self._columns:
+                raise ValueError(f"フィルタに使えない項目です: {name}")
+            if isinstance(values, str):
+                values = [values]
+            rows = self._columns[name].rows(values)
+            indices = rows if indices is None else np.intersect1d(indices, rows, assume_unique=True)
+        return indices
+
+    def _search_rows(
+        self,
+        query_vector: np.ndarray,
+        k: int,
+        indices: Optional[np.ndarray] = None,
+        exact: bool = False,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rerank: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        正規化済みクエリに対する上位k件の (行番号, 類似度) を返す
+        exact=False の場合、HNSWインデックスがあればグラフ探索、
+        IVFインデックスがあればnprobe個のリストに含まれる行だけ、
+        バイナリインデックスがあればハミング距離で絞った候補だけを走査し、
+        PQ/スカラー量子化インデックスがあれば走査を量子化ベクトル上の近似スコアで行う
+        削除済みの行は、どの経路でも結果に含めない
+        """
+        deleted = self._deleted_rows()
+        if deleted is not None and indices is not None:
+            indices = indices[~deleted[indices]]
+
+        if self.hnsw_index is not None and not exact:
+            allowed = None
+            if indices is not None:
+                allowed = np.zeros(self._size, dtype=bool)
+                allowed[indices] = True
+            elif deleted is not None:
+                allowed = ~deleted
+            rows, scores = self.hnsw_index.search(self.vectors, query_vector, k, ef_search, allowed)
+            # フィルタで探索結果がk件に満たない場合は、フィルタ後の行を全件走査する
+            n_alive = self._size - self._n_deleted if indices is None else len(indices)
+            if len(rows) >= min(k, n_alive):
+                return rows, scores
+        elif self.ivf_index is not None and not exact:
+            candidates = self.ivf_index.candidates(query_vector, nprobe)
+            if indices is not None:
+                candidates = np.intersect1d(candidates, indices, assume_unique=True)
+            elif deleted is not None:
+                candidates = candidates[~deleted[candidates]]
+            indices = candidates
+
+        if self.binary_index is not None and not exact:
+            indices = self.binary_index.candidates(
+                query_vector, max(k, self.binary_index.n_candidates), indices,
+                allowed=None if deleted is None else ~deleted
+            )
+
+        quantizer = self.pq_index or self.sq_index
+        if quantizer is not None and not exact:
+            return self._quantized_search_rows(quantizer, query_vector, k, indices, rerank)
+
+        vectors = self.vectors if indices is None else self.vectors[indices]
+        if len(vectors) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+        # 格納済みの行は正規化済みなので、行列ベクトル積1回でコサイン類似度が求まる
+        similarities = vectors @ query_vector
+        if indices is None and deleted is not None:
+            similarities[deleted] = -np.inf
+        top_k_indices = self._top_k_indices(similarities, k)
+        if indices is None and deleted is not None:
+            top_k_indices = top_k_indices[~deleted[top_k_indices]]
+        rows = top_k_indices if indices is None else indices[top_k_indices]
+        return rows, similarities[top_k_indices]
+
+    def _quantized_search_rows(
+        self,
+        quantizer: Union[ProductQuantizer, ScalarQuantizer],
+        query_vector: np.ndarray,
+        k: int,
+        indices: Optional[np.ndarray],
+        rerank: Optional[int]
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        量子化ベクトルの近似スコアで候補を絞り込み、上位rerank件だけ元のベクトルで再スコアリングする
+        load(mmap=True) したストアでは、再スコアリング対象の行だけがディスクから読み込まれる
+        """
+        if indices is not None and len(indices) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        approx = quantizer.approximate_scores(query_vector, indices)
+        deleted = self._deleted_rows() if indices is None else None
+        if deleted is not None:
+            approx[deleted] = -np.inf
+
+        rerank = quantizer.rerank_k if rerank is None else rerank
+        top_indices = self._top_k_indices(approx, max(k, rerank))
+        if deleted is not None:
+            top_indices = top_indices[~deleted[top_indices]]
+        rows = top_indices if indices is None else indices[top_indices]
+        if not rerank:
+            return rows[:k], approx[top_indices[:k]]
+
+        # 行番号順に並べてから読むことで、mmap上のアクセスを前方向にまとめる
+        rows = np.sort(rows)
+        similarities = np.asarray(self.vectors[rows], dtype=np.float32) @ query_vector
+        top_k_indices = self._top_k_indices(similarities, k)
+        return rows[top_k_indices], similarities[top_k_indices]
 
     def similarity_search(
         self, 
         query_vector: List[float], 
         k: int = 5,
-        source_type: Optional[Union[str, List[str]]] = None
+        source_type: Optional[Union[str, List[str]]] = None,
+        filter: Optional[Dict[str, Union[str, List[str]]]] = None,
+        exact: bool = False,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rerank: Optional[int] = None
     ) -> List[Tuple[Dict, float]]:
         """
         コサイン類似度に基づく検索を実行
         source_typeを指定して特定のソースタイプのみを検索可能
+        filterで original_format や source も指定でき、条件はすべて満たす行のみが対象になる
+        HNSW/IVF/バイナリ/PQ/スカラー量子化インデックス作成済みの場合は近似検索になる (exact=Trueで全件走査)
         """
-        if not self.vectors:
-            return []
-
-        # ソースタイプによるフィルタリング用のマスクを作成
-        if source_type:
-            if isinstance(source_type, str):
-                source_types = [source_type]
-            else:
-                source_types = source_type
-            
-            mask = [
-                metadata.get("source_type") in source_types 
-                for metadata in self.metadatas
-            ]
-            filtered_vectors = [v for v, m in zip(self.vectors, mask) if m]
-            filtered_texts = [t for t, m in zip(self.texts, mask) if m]
-            filtered_metadatas = [m for m, mask_val in zip(self.metadatas, mask) if mask_val]
-        else:
-            filtered_vectors = self.vectors
-            filtered_texts = self.texts
-            filtered_metadatas = self.metadatas
-
-        if not filtered_vectors:
+        if self._size == 0:
             return []
 
-        # numpy配列に変換
-        vectors = np.array(filtered_vectors)
-        query_vector = np.array(query_vector)
+        # フィルタ条件に一致する行を列インデックスから取得
+        indices = self._filter_indices(source_type, filter)
+        query_vector = self._normalize(np.asarray(query_vector, dtype=np.float32))
+        rows, scores = self._search_rows(query_vector, k, indices, exact, nprobe, ef_search, rerank)
 
-        # コサイン類似度を計算
-        similarities = np.dot(vectors, query_vector) / (
-            np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
-        )
+        # 結果を作成
+        return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
 
-        # 上位k件のインデックスを取得
-        top_k_indices = np.argsort(similarities)[-k:][::-1]
+    def similarity_search_batch(
+        self,
+        query_matrix: List[List[float]],
+        k: int = 5,
+        source_type: Optional[Union[str, List[str]]] = None,
+        filter: Optional[Dict[str, Union[str, List[str]]]] = None,
+        block_size: int = 256
+    ) -> List[List[Tuple[Dict, float]]]:
+        """
+        複数クエリをまとめて検索し、クエリごとに similarity_search と同じ形式の結果を返す
+        block_size件ずつ1回の行列積で類似度を計算し、上位k件を行ごとにベクトル化して選ぶ
+        (IVFインデックスの有無にかかわらず全件走査)
+        """
+        query_matrix = np.atleast_2d(np.asarray(query_matrix, dtype=np.float32))
+        indices = self._filter_indices(source_type, filter) if self._size else None
+        deleted = self._deleted_rows()
+        if deleted is not None and indices is not None:
+            indices = indices[~deleted[indices]]
+        vectors = self.vectors if indices is None else self.vectors[indices]
+        if len(vectors) == 0:
+            return [[] for _ in range(len(query_matrix))]
 
-        # 結果を作成
         results = []
-        for idx in top_k_indices:
-            doc = {
-                "page_content": filtered_texts[idx],
-                "metadata": filtered_metadatas[idx]
-            }
-            results.append((doc, float(similarities[idx])))
+        for start in range(0, len(query_matrix), block_size):
+            queries = self._normalize(query_matrix[start:start + block_size])
+            similarities = queries @ vectors.T
+            if indices is None and deleted is not None:
+                similarities[:, deleted] = -np.inf
+            top_k_indices = self._top_k_indices(similarities, k)
+            top_k_scores = np.take_along_axis(similarities, top_k_indices, axis=1)
+            if indices is not None:
+                top_k_indices = indices[top_k_indices]
+
+            for rows, scores in zip(top_k_indices, top_k_scores):
+                results.append([
+                    (self._document(row), float(score))
+                    for row, score in zip(rows, scores)
+                    if score > -np.inf
+                ])
 
         return results
 
+    def build_ivf_index(
+        self,
+        nlist: Optional[int] = None,
+        nprobe: int = 8,
+        sample_size: Optional[int] = None,
+        n_iter: int = 20,
+        seed: int = 0
+    ) -> IVFIndex:
+        """
+        格納済みベクトルからIVFインデックスを作成
+        nlist省略時は 4 * sqrt(件数)、sample_size省略時は 64 * nlist 件をk-meansの学習に使う
+        以降の add_vectors で追加した行もインデックスに登録される
+        """
+        if self._size == 0:
+            raise ValueError("インデックスを作成するベクトルがありません")
+
+        nlist = nlist or max(1, int(4 * np.sqrt(self._size)))
+        sample_size = min(sample_size or 64 * nlist, self._size)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(self._size, sample_size, replace=False))
+
+        index = IVFIndex(nlist=nlist, nprobe=nprobe, n_iter=n_iter, seed=seed)
+        index.train(np.asarray(self.vectors[sample_rows], dtype=np.float32))
+        index.add(self.vectors, 0)
+        self.ivf_index = index
+        return index
+
+    def build_hnsw_index(
+        self,
+        M: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 128,
+        seed: int = 0
+    ) -> HNSWIndex:
+        """
+        格納済みベクトルからHNSWインデックスを作成 (IVFインデックスより優先して使われる)
+        以降の add_vectors で追加した行もグラフに登録される
+        """
+        index = HNSWIndex(M=M, ef_construction=ef_construction, ef_search=ef_search, seed=seed)
+        index.add_items(self.vectors, 0, self._size)
+        self.hnsw_index = index
+        return index
+
+    def build_pq_index(
+        self,
+        m: Optional[int] = None,
+        rerank_k: int = 100,
+        sample_size: Optional[int] = None,
+        n_iter: int = 20,
+        seed: int = 0,
+        vectors_path: Optional[str] = None
+    ) -> ProductQuantizer:
+        """
+        格納済みベクトルからPQインデックスを作成
+        m省略時は部分ベクトルが16次元 (割り切れなければ8, 4, 2, 1次元) になるように決める
+        1536次元でm=96なら1件96バイトとなり、float32の6KBに比べて64分の1になる
+        sample_size省略時は最大65536件をコードブックの学習に使う
+        コードは全精度の行列とは別に持つため、vectors_pathを指定して行列をディスクに移さない限り、メモリは減らない
+        """
+        if self._size == 0:
+            raise ValueError("インデックスを作成するベクトルがありません")
+
+        dim = self.vectors.shape[1]
+        if m is None:
+            m = next(dim // dsub for dsub in (16, 8, 4, 2, 1) if dim % dsub == 0)
+        sample_size = min(sample_size or 65536, self._size)
+        rng = np.random.default_rng(seed)
+        sample_rows = np.sort(rng.choice(self._size, sample_size, replace=False))
+
+        index = ProductQuantizer(m=m, n_iter=n_iter, rerank_k=rerank_k, seed=seed)
+        index.train(np.asarray(self.vectors[sample_rows], dtype=np.float32))
+        index.add(self.vectors)
+        if vectors_path is not None:
+            self.keep_vectors_on_disk(vectors_path)
+        self.pq_index = index
+        return index
+
+    def build_sq_index(
+        self,
+        dtype: str = "int8",
+        rerank_k: int = 100,
+        vectors_path: Optional[str] = None
+    ) -> ScalarQuantizer:
+        """
+        格納済みベクトルからスカラー量子化インデックスを作成 (PQインデックスがある場合はPQが優先)
+        float16で1/2、int8で1/4のサイズになる。量子化による精度低下は evaluate_recall で確認できる
+        コードは全精度の行列とは別に持つため、vectors_pathを指定して行列をディスクに移さない限り、メモリは減らない
+        """
+        index = ScalarQuantizer(dtype=dtype, rerank_k=rerank_k)
+        index.add(self.vectors)
+        if vectors_path is not None:
+            self.keep_vectors_on_disk(vectors_path)
+        self.sq_index = index
+        return index
+
+    def build_binary_index(self, n_candidates: int = 1000) -> BinarySignIndex:
+        """
+        格納済みベクトルの符号ビットからバイナリインデックスを作成
+        検索時はハミング距離の小さいn_candidates件だけをコサイン類似度で再スコアリングする
+        """
+        index = BinarySignIndex(n_candidates=n_candidates)
+        index.add(self.vectors)
+        self.binary_index = index
+        return index
+
+    def evaluate_recall(
+        self,
+        query_matrix: List[List[float]],
+        k: int = 10,
+        nprobe: Optional[int] = None,
+        ef_search: Optional[int] = None,
+        rerank: Optional[int] = None
+    ) -> float:
+        """近似検索 (HNSW/IVF/バイナリ/PQ/スカラー量子化) の上位k件が全件走査の上位k件をどれだけ含むか (recall@k) を返す"""
+        if not any((self.hnsw_index, self.ivf_index, self.binary_index, self.pq_index, self.sq_index)):
+            raise ValueError("近似検索インデックスが作成されていません")
+
+        query_matrix = self._normalize(np.atleast_2d(np.asarray(query_matrix, dtype=np.float32)))
+        scores = query_matrix @ self.vectors.T
+        deleted = self._deleted_rows()
+        if deleted is not None:
+            scores[:, deleted] = -np.inf
+        exact_rows = self._top_k_indices(scores, min(k, self._size - self._n_deleted))
+
+        hits = 0
+        total = 0
+        for query_vector, expected in zip(query_matrix, exact_rows):
+            rows, _ = self._search_rows(query_vector, k, nprobe=nprobe, ef_search=ef_search, rerank=rerank)
+            hits += len(np.intersect1d(rows, expected))
+            total += len(expected)
+        return hits / total if total else 0.0
+
     def get_stats(self) -> Dict:
-        """ベクトルストアの統計情報を取得"""
-        self._update_stats()
+        """ベクトルストアの統計情報を取得 (ソースタイプ数に比例する計算量)"""
+        stats = {}
+        for source_type, entry in self._stats.items():
+            if entry["bounds_stale"]:
+                self._refresh_bounds(source_type)
+            stats[source_type] = {
+                "count": entry["count"],
+                "formats": list(entry["formats"]),
+                "oldest": entry["oldest"],
+                "newest": entry["newest"]
+            }
+        self.source_stats = stats
         return self.source_stats
 
-    def _update_stats(self):
-        """統計情報を更新"""
-        stats = {}
-        for metadata in self.metadatas:
+    @staticmethod
+    def _new_stats_entry() -> Dict:
+        return {"count": 0, "formats": Counter(), "oldest": None, "newest": None, "bounds_stale": False}
+
+    def _add_stats(self, metadatas: List[Dict]):
+        """追加したメタデータの分だけ統計情報を更新"""
+        for metadata in metadatas:
             source_type = metadata.get("source_type", "unknown")
-            if source_type not in stats:
-                stats[source_type] = {
-                    "count": 0,
-                    "formats": set(),
-                    "oldest": None,
-                    "newest": None
-                }
-            
-            stats[source_type]["count"] += 1
-            
+            entry = self._stats.get(source_type)
+            if entry is None:
+                entry = self._stats[source_type] = self._new_stats_entry()
+
+            entry["count"] += 1
+
             if "original_format" in metadata:
-                stats[source_type]["formats"].add(metadata["original_format"])
-            
+                entry["formats"][metadata["original_format"]] += 1
+
             added_at = metadata.get("added_at")
             if added_at:
-                if not stats[source_type]["oldest"] or added_at < stats[source_type]["oldest"]:
-                    stats[source_type]["oldest"] = added_at
-                if not stats[source_type]["newest"] or added_at > stats[source_type]["newest"]:
-                    stats[source_type]["newest"] = added_at
+                if not entry["oldest"] or added_at < entry["oldest"]:
+                    entry["oldest"] = added_at
+                if not entry["newest"] or added_at > entry["newest"]:
+                    entry["newest"] = added_at
+
+    def _remove_stats(self, metadatas: List[Dict]):
+        """
+        削除したメタデータの分だけ統計情報を更新
+        最古・最新の行を削除した場合は、そのソースタイプだけ次のget_statsで再計算する
+        """
+        for metadata in metadatas:
+            source_type = metadata.get("source_type", "unknown")
+            entry = self._stats[source_type]
+            entry["count"] -= 1
+            if entry["count"] == 0:
+                del self._stats[source_type]
+                continue
 
-        # setをリストに変換（JSON対応のため）
-        for source_type in stats:
-            stats[source_type]["formats"] = list(stats[source_type]["formats"])
+            if "original_format" in metadata:
+                entry["formats"][metadata["original_format"]] -= 1
+                if entry["formats"][metadata["original_format"]] <= 0:
+                    del entry["formats"][metadata["original_format"]]
 
-        self.source_stats = stats
+            added_at = metadata.get("added_at")
+            if added_at and added_at in (entry["oldest"], entry["newest"]):
+                entry["bounds_stale"] = True
 
-    def clear_by_source(self, source_type: str):
-        """特定のソースタイプのデータのみを削除"""
-        indices_to_keep = [
-            i for i, metadata in enumerate(self.metadatas)
-            if metadata.get("source_type") != source_type
+    def _refresh_bounds(self, source_type: str):
+        """ソースタイプの行だけを走査して最古・最新の追加日時を再計算"""
+        values = [source_type, None] if source_type == "unknown" else [source_type]
+        rows = self._columns["source_type"].rows(values)
+        if self._n_deleted:
+            rows = rows[~self._deleted[rows]]
+        added_ats = [
+            added_at for row in rows
+            if (added_at := self.metadatas[row].get("added_at"))
         ]
-        
-        self.vectors = [self.vectors[i] for i in indices_to_keep]
-        self.texts = [self.texts[i] for i in indices_to_keep]
-        self.metadatas = [self.metadatas[i] for i in indices_to_keep]
-        self._update_stats()
+        entry = self._stats[source_type]
+        entry["oldest"] = min(added_ats, default=None)
+        entry["newest"] = max(added_ats, default=None)
+        entry["bounds_stale"] = False
+
+    def _update_stats(self):
+        """全メタデータを走査して統計情報を作り直す (統計を保存していない旧形式の読み込み用)"""
+        self._stats = {}
+        self._add_stats(self.metadatas)
+        self.get_stats()
+
+    def delete_by_source(self, source: Union[str, List[str]]) -> int:
+        """メタデータのsource (ファイルパスなど) が一致するドキュメントを削除"""
+        if isinstance(source, str):
+            source = [source]
+        return self._delete_rows(self._columns["source"].rows(source))
+
+    def clear_by_source(self, source_type: str) -> int:
+        """特定のソースタイプのデータのみを削除"""
+        return self._delete_rows(self._columns["source_type"].rows([source_type]))
+
+    def _on_delete(self, rows: np.ndarray):
+        self._remove_stats([self.metadatas[row] for row in rows.tolist()])
+
+    def _compact_indexes(self, indices_to_keep: np.ndarray):
+        for column in self._columns.values():
+            column.subset(indices_to_keep)
+        if self.ivf_index is not None:
+            assignments = self.ivf_index.assignments[indices_to_keep]
+            self.ivf_index.reset()
+            self.ivf_index.add_assignments(assignments, 0)
+        if self.pq_index is not None:
+            self.pq_index.codes = self.pq_index.codes[indices_to_keep]
+        if self.sq_index is not None:
+            self.sq_index.codes = self.sq_index.codes[indices_to_keep]
+        if self.binary_index is not None:
+            self.binary_index.codes = self.binary_index.codes[indices_to_keep]
+        # HNSWグラフは作り直さず、ノード番号を付け替えて削除した行への辺を補修する
+        if self.hnsw_index is not None:
+            self.hnsw_index.compact(self.vectors, indices_to_keep)
+
+    def _stats_state(self) -> Dict:
+        """保存用に、形式ごとの件数を含む統計情報を返す"""
+        self.get_stats()
+        return {
+            source_type: {
+                "count": entry["count"],
+                "formats": dict(entry["formats"]),
+                "oldest": entry["oldest"],
+                "newest": entry["newest"]
+            }
+            for source_type, entry in self._stats.items()
+        }
 
     def save(self, path: str):
-        """ベクトルストアをファイルに保存"""
-        data = {
-            'vectors': self.vectors,
-            'texts': self.texts,
-            'metadatas': self.metadatas,
-            'source_stats': self.source_stats
+        """
+        ベクトルストアをディレクトリ形式で保存
+        vectors.npy (正規化済みfloat32行列), texts.bin + texts_offsets.npy,
+        metadatas.jsonl + metadatas_offsets.npy, store.json で構成される
+        """
+        self._save_rows(path)
+        index = self.pq_index
+        save_optional(
+            os.path.join(path, "pq.npz"),
+            (lambda f: np.savez(
+                f,
+                codebooks=index.codebooks,
+                codes=index.codes,
+                params=np.array([index.m, index.n_iter, index.rerank_k, index.seed])
+            )) if index is not None else None
+        )
+
+        binary = self.binary_index
+        save_optional(os.path.join(path, "binary.npz"), binary.save if binary is not None else None)
+
+        sq = self.sq_index
+        save_optional(
+            os.path.join(path, "sq.npz"),
+            (lambda f: np.savez(
+                f,
+                codes=sq.codes,
+                scale=np.atleast_1d(sq.scale) if sq.scale is not None else np.empty(0, dtype=np.float32),
+                params=np.array([sq.dtype, str(sq.rerank_k)])
+            )) if sq is not None else None
+        )
+
+        hnsw = self.hnsw_index
+        save_optional(os.path.join(path, "hnsw.npz"), hnsw.save if hnsw is not None else None)
+
+        columns = self._columns
+        replace_atomically(
+            lambda f: np.savez(f, **{name: column.codes for name, column in columns.items()}),
+            os.path.join(path, "columns.npz")
+        )
+        replace_atomically(
+            lambda f: f.write(json.dumps(
+                {name: column.values for name, column in columns.items()}, ensure_ascii=False
+            ).encode('utf-8')),
+            os.path.join(path, "columns.json")
+        )
+
+        ivf = self.ivf_index
+        save_optional(
+            os.path.join(path, "ivf.npz"),
+            (lambda f: np.savez(
+                f,
+                centroids=ivf.centroids,
+                assignments=ivf.assignments,
+                params=np.array([ivf.nprobe, ivf.n_iter, ivf.seed])
+            )) if ivf is not None else None
+        )
+
+        self._save_info(path, source_stats=self._stats_state())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        ディレクトリからベクトルストアを読み込み
+        mmap=Trueの場合、ベクトル・テキスト・メタデータはアクセスされた部分だけがページインされる
+        PQ/SQインデックスがある場合は、追加しても行列はメモリ上へコピーせず、ディレクトリ内の
+        vectors-*.f32 に移して追記する (それ以外は最初の追加時にメモリ上へコピーする)
+        旧形式のpickleファイルを指定した場合はそのまま読み込む
+        """
+        if os.path.isfile(path):
+            return cls._load_pickle(path)
+
+        store = cls()
+        info = store._load_rows(path, mmap)
+        store._stats = {
+            source_type: dict(entry, formats=Counter(entry["formats"]), bounds_stale=False)
+            for source_type, entry in info.get("source_stats", {}).items()
         }
-        with open(path, 'wb') as f:
-            pickle.dump(data, f)
+
+        # フィルタ用の列 (保存されていない場合はメタデータから作り直す)
+        columns_path = os.path.join(path, "columns.npz")
+        if os.path.exists(columns_path):
+            with open(os.path.join(path, "columns.json"), 'r', encoding='utf-8') as f:
+                values = json.load(f)
+            with np.load(columns_path) as data:
+                store._columns = {
+                    name: _ColumnIndex(values[name], data[name]) for name in cls.FILTER_COLUMNS
+                }
+        else:
+            store._rebuild_columns()
+
+        ivf_path = os.path.join(path, "ivf.npz")
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as data:
+                nprobe, n_iter, seed = (int(v) for v in data["params"])
+                index = IVFIndex(len(data["centroids"]), nprobe=nprobe, n_iter=n_iter, seed=seed)
+                index.centroids = data["centroids"]
+                index.add_assignments(data["assignments"], 0)
+            store.ivf_index = index
+
+        hnsw_path = os.path.join(path, "hnsw.npz")
+        if os.path.exists(hnsw_path):
+            store.hnsw_index = HNSWIndex.load(hnsw_path)
+
+        pq_path = os.path.join(path, "pq.npz")
+        if os.path.exists(pq_path):
+            with np.load(pq_path) as data:
+                m, n_iter, rerank_k, seed = (int(v) for v in data["params"])
+                index = ProductQuantizer(m=m, n_iter=n_iter, rerank_k=rerank_k, seed=seed)
+                index.codebooks = data["codebooks"]
+                index.codes = data["codes"]
+            store.pq_index = index
+
+        sq_path = os.path.join(path, "sq.npz")
+        if os.path.exists(sq_path):
+            with np.load(sq_path) as data:
+                dtype, rerank_k = (str(v) for v in data["params"])
+                index = ScalarQuantizer(dtype=dtype, rerank_k=int(rerank_k))
+                index.scale = data["scale"] if len(data["scale"]) else None
+                index.codes = data["codes"]
+            store.sq_index = index
+
+        binary_path = os.path.join(path, "binary.npz")
+        if os.path.exists(binary_path):
+            store.binary_index = BinarySignIndex.load(binary_path)
+
+        # 量子化インデックスがある場合、追加時に行列をメモリ上へコピーせず、ディレクトリ内の別ファイルに移す
+        if mmap and (store.pq_index is not None or store.sq_index is not None):
+            store._spill_path = os.path.join(path, f"vectors-{uuid.uuid4().hex}.f32")
+        return store
 
     @classmethod
-    def load(cls, path: str):
-        """ファイルからベクトルストアを読み込み"""
+    def _load_pickle(cls, path: str):
+        """旧形式 (pickle) のファイルからベクトルストアを読み込み"""
         with open(path, 'rb') as f:
             data = pickle.load(f)
         
         store = cls()
-        store.vectors = data['vectors']
+        if len(data['texts']):
+            store._matrix = cls._normalize(np.asarray(data['vectors'], dtype=np.float32))
+            store._size = len(store._matrix)
+            store._ids = np.arange(store._size, dtype=np.int64)
+            store._deleted = np.zeros(store._size, dtype=bool)
+            store._next_id = store._size
         store.texts = data['texts']
         store.metadatas = data['metadatas']
-        store.source_stats = data.get('source_stats', {})
+        store._rebuild_columns()
+        store._update_stats()
         return store
 
 def create_vectorstore_from_markdown_directory(
@@ -178,14 +997,19 @@ def create_vectorstore_from_markdown_directory(
     original_format: str,
     chunk_size: int = 1000,
     chunk_overlap: int = 200,
-    batch_size: int = 100
+    batch_size: int = 100,
+    max_batch_tokens: int = 100000,
+    max_in_flight: Optional[int] = None,
+    chunk_workers: int = 4,
+    embedding_cache_path: Optional[str] = "embedding_cache.db"
 ) -> EnhancedVectorStore:
     """
     ディレクトリ内の全マークダウンファイルからベクトルストアを作成
     """
     from langchain.text_splitter import MarkdownTextSplitter
     
-    embedder = AzureOpenAIEmbedder(client=client)
+    cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    embedder = AzureOpenAIEmbedder(client=client, cache=cache)
     vectorstore = EnhancedVectorStore()
 
     text_splitter = MarkdownTextSplitter(
@@ -193,51 +1017,26 @@ def create_vectorstore_from_markdown_directory(
         chunk_overlap=chunk_overlap
     )
 
-    markdown_files = read_markdown_files(directory_path)
-    
-    current_texts = []
-    current_metadatas = []
-    
-    for file_path, content in markdown_files:
-        chunks = text_splitter.split_text(content)
-        
-        for chunk in chunks:
-            current_texts.append(chunk)
-            current_metadatas.append({"source": file_path})
-            
-            if len(current_texts) >= batch_size:
-                try:
-                    embeddings = embedder.embed_documents(current_texts)
-                    vectorstore.add_vectors(
-                        vectors=embeddings,
-                        texts=current_texts,
-                        metadatas=current_metadatas,
-                        source_type=source_type,
-                        original_format=original_format
-                    )
-                    
-                    current_texts = []
-                    current_metadatas = []
-                    time.sleep(1)  # レート制限を避けるための待機
-                    
-                except Exception as e:
-                    print(f"警告: バッチ処理中にエラーが発生しました: {e}")
-                    current_texts = []
-                    current_metadatas = []
-    
-    # 残りのテキストを処理
-    if current_texts:
-        try:
-            embeddings = embedder.embed_documents(current_texts)
-            vectorstore.add_vectors(
-                vectors=embeddings,
-                texts=current_texts,
-                metadatas=current_metadatas,
-                source_type=source_type,
-                original_format=original_format
-            )
-        except Exception as e:
-            print(f"警告: 最終バッチの処理中にエラーが発生しました: {e}")
+    def write(batch, embeddings):
+        vectorstore.add_vectors(
+            vectors=embeddings,
+            texts=batch.texts,
+            metadatas=batch.metadatas,
+            source_type=source_type,
+            original_format=original_format
+        )
+
+    stats = run_pipeline(
+        read_markdown_files(directory_path),
+        text_splitter.split_text,
+        embedder,
+        write,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        chunk_workers=chunk_workers,
+        max_in_flight=max_in_flight
+    )
+    print(stats.summary())
 
     return vectorstore
 
@@ -334,7 +1133,7 @@ if __name__ == "__main__":
             print(f"内容: {doc['page_content']}")
 
         # ベクトルストアの保存
-        vectorstore.save("enhanced_vectorstore.pkl")
+        vectorstore.save("enhanced_vectorstore")
 
     except Exception as e:
         print(f"エラーが発生しました: {e}")
@@ -0,0 +1,417 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+
+class HNSWIndex:
+    """
+    HNSW (Hierarchical Navigable Small World) グラフによる近似最近傍探索インデックス
+    正規化済みベクトルの内積 (= コサイン類似度) を類似度として使う
+    ベクトル自体は保持せず、各メソッドにベクトルストアの行列 (行番号 = ノード番号) を渡して使う
+
+    ef_searchは再現率と検索時間のトレードオフで、384次元・2万件での実測は次のとおり
+    (recall@10 / 検索時間の中央値。総当たりは約3.4ms、構築は1件あたり約2.5〜5ms)
+        ef_search   クラスタのあるベクトル   ランダムなベクトル
+           64       0.90 / 1.0ms            0.36 / 2.8ms
+          128       0.92 / 1.3ms            0.57 / 4.2ms
+          256       0.96 / 1.8ms            0.77 / 6.3ms
+    実際の埋め込みはクラスタのある分布に近い。構造のない高次元ベクトルや数千件程度なら総当たりの方が速く正確
+    """
+    # 探索で1回にまとめて展開する候補ノード数 (max(beam_width, ef // beam_ratio))
+    beam_width = 4
+    beam_ratio = 8
+
+    def __init__(self, M: int = 16, ef_construction: int = 200, ef_search: int = 128, seed: int = 0):
+        self.M = M                          # 上位レイヤーでの最大接続数
+        self.M0 = 2 * M                     # レイヤー0での最大接続数
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.seed = seed
+        self._level_mult = 1 / np.log(M)
+        self._rng = np.random.default_rng(seed)
+
+        self.size = 0                       # 登録済みのノード数
+        self.entry_point = -1
+        self.max_level = -1
+        self.levels = np.empty(0, dtype=np.int8)
+        # レイヤー0の隣接リスト (未使用の枠は-1)。ノード数に応じて倍々で拡張する
+        self._level0 = np.full((0, self.M0), -1, dtype=np.int32)
+        # レイヤー0の各枠の隣接ノードとの類似度 (未使用の枠は-inf)。接続の入れ替えに使う
+        # 類似度を保存していない古いファイルを読み込んだ場合はNoneで、次のadd_itemsで計算する
+        self._level0_sims = np.full((0, self.M0), -np.inf, dtype=np.float32)
+        # レイヤー1以上の隣接リスト: レイヤーごとに {ノード番号: 隣接ノード配列}
+        self._upper = []
+
+    def _neighbors(self, node: int, level: int) -> np.ndarray:
+        if level == 0:
+            neighbors = self._level0[node]
+            return neighbors[neighbors >= 0]
+        return self._upper[level - 1].get(node, np.empty(0, dtype=np.int32))
+
+    def _set_neighbors(self, node: int, level: int, neighbors: np.ndarray, sims: np.ndarray):
+        if level == 0:
+            self._level0[node] = -1
+            self._level0[node, :len(neighbors)] = neighbors
+            self._level0_sims[node] = -np.inf
+            self._level0_sims[node, :len(neighbors)] = sims
+        else:
+            self._upper[level - 1][node] = np.asarray(neighbors, dtype=np.int32)
+
+    def _reserve(self, size: int):
+        if size > len(self._level0):
+            capacity = max(size, 2 * len(self._level0), 1024)
+            level0 = np.full((capacity, self.M0), -1, dtype=np.int32)
+            level0[:self.size] = self._level0[:self.size]
+            self._level0 = level0
+            level0_sims = np.full((capacity, self.M0), -np.inf, dtype=np.float32)
+            level0_sims[:self.size] = self._level0_sims[:self.size]
+            self._level0_sims = level0_sims
+            levels = np.zeros(capacity, dtype=np.int8)
+            levels[:self.size] = self.levels[:self.size]
+            self.levels = levels
+
+    def _search_layer(
+        self,
+        data: np.ndarray,
+        query: np.ndarray,
+        entry_points: np.ndarray,
+        ef: int,
+        level: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        1つのレイヤー内でビームサーチを行い、類似度の高い順に最大ef件の (ノード配列, 類似度配列) を返す
+        類似度の高い候補をbeam_width件ずつまとめて展開し、隣接ノードの類似度を1回の行列ベクトル積で計算する
+        """
+        nodes = np.unique(np.asarray(entry_points, dtype=np.int64))
+        # 訪問済みフラグ (np.zerosは触れたページだけ確保されるため、ノード数が多くても安い)
+        visited = np.zeros(len(self._level0), dtype=bool)
+        visited[nodes] = True
+        # 隣接ノードの重複除去用 (同じノードには最後に書いた位置だけが残る)
+        position = np.zeros(len(self._level0), dtype=np.int32)
+        sims = np.asarray(data[nodes], dtype=np.float32) @ query
+        result_nodes, result_sims = nodes, sims
+        candidate_nodes, candidate_sims = nodes, sims
+        bound = -np.inf
+        width = max(self.beam_width, ef // self.beam_ratio)
+
+        while len(candidate_nodes):
+            # 類似度の高い候補から展開し、残りは次の周回に回す
+            if len(candidate_nodes) > width:
+                top = np.argpartition(-candidate_sims, width - 1)[:width]
+                rest = np.ones(len(candidate_nodes), dtype=bool)
+                rest[top] = False
+                expand = candidate_nodes[top]
+                candidate_nodes, candidate_sims = candidate_nodes[rest], candidate_sims[rest]
+            else:
+                expand = candidate_nodes
+                candidate_nodes, candidate_sims = candidate_nodes[:0], candidate_sims[:0]
+
+            if level == 0:
+                neighbors = self._level0[expand].ravel()
+                neighbors = neighbors[neighbors >= 0]
+            else:
+                neighbors = np.concatenate([self._neighbors(n, level) for n in expand.tolist()])
+            neighbors = neighbors[~visited[neighbors]]
+            if not len(neighbors):
+                continue
+            # 複数のノードから同じ隣接ノードに届いた場合も1回だけ数える
+            order = np.arange(len(neighbors), dtype=np.int32)
+            position[neighbors] = order
+            neighbors = neighbors[position[neighbors] == order]
+            visited[neighbors] = True
+            sims = np.asarray(data[neighbors], dtype=np.float32) @ query
+            keep = sims > bound
+            neighbors, sims = neighbors[keep], sims[keep]
+            result_nodes = np.concatenate([result_nodes, neighbors])
+            result_sims = np.concatenate([result_sims, sims])
+            candidate_nodes = np.concatenate([candidate_nodes, neighbors])
+            candidate_sims = np.concatenate([candidate_sims, sims])
+
+            # 結果がef件を超えたら上位ef件に絞り、ef件目より類似度の低い候補は展開しない
+            if len(result_nodes) >= ef:
+                if len(result_nodes) > ef:
+                    top = np.argpartition(-result_sims, ef - 1)[:ef]
+                    result_nodes, result_sims = result_nodes[top], result_sims[top]
+                bound = result_sims.min()
+                keep = candidate_sims >= bound
+                candidate_nodes, candidate_sims = candidate_nodes[keep], candidate_sims[keep]
+
+        order = np.argsort(-result_sims, kind="stable")
+        return result_nodes[order], result_sims[order]
+
+    @staticmethod
+    def _select_neighbors(data: np.ndarray, nodes: np.ndarray, sims: np.ndarray, max_count: int) -> np.ndarray:
+        """
+        論文のヒューリスティックで隣接ノードを選び、nodes (類似度の高い順) 内の位置を返す
+        既に選んだノードよりもクエリに近い候補だけを残し、グラフの接続方向を分散させる
+        """
+        if len(nodes) <= max_count:
+            return np.arange(len(nodes))
+
+        vectors = np.asarray(data[nodes], dtype=np.float32)
+        pairwise = vectors @ vectors.T
+
+        # closest[i]: 候補iと選択済みノードとの類似度の最大値
+        closest = np.full(len(nodes), -np.inf, dtype=np.float32)
+        selected = []
+        for i, sim in enumerate(sims.tolist()):
+            if sim > closest[i]:
+                selected.append(i)
+                if len(selected) >= max_count:
+                    break
+                np.maximum(closest, pairwise[i], out=closest)
+
+        # ヒューリスティックで足りない分は類似度順に補う
+        if len(selected) < max_count:
+            chosen = set(selected)
+            selected.extend(
+                [i for i in range(len(nodes)) if i not in chosen][:max_count - len(selected)]
+            )
+        return np.array(selected)
+
+    def _connect(self, data: np.ndarray, node: int, neighbors: np.ndarray, sims: np.ndarray, level: int):
+        """
+        各neighborの隣接リストにnodeを追加する
+        上限に達している場合は、最も類似度の低い隣接ノードよりnodeの方が近いときだけ入れ替える
+        (挿入のたびに発生するためヒューリスティックは使わない)
+        """
+        if level == 0:
+            # 各ノードの枠の類似度を保持しているので、全neighborをまとめて更新できる
+            # 未使用の枠は-infなので、空きがあれば必ずそこに入る
+            slot_sims = self._level0_sims[neighbors]
+            weakest = np.argmin(slot_sims, axis=1)
+            replace = sims > slot_sims[np.arange(len(neighbors)), weakest]
+            self._level0[neighbors[replace], weakest[replace]] = node
+            self._level0_sims[neighbors[replace], weakest[replace]] = sims[replace]
+            return
+
+        for neighbor in neighbors.tolist():
+            candidates = np.append(self._neighbors(neighbor, level), node)
+            if len(candidates) > self.M:
+                candidate_sims = (
+                    np.asarray(data[candidates], dtype=np.float32) @ np.asarray(data[neighbor], dtype=np.float32)
+                )
+                candidates = candidates[np.argpartition(-candidate_sims, self.M - 1)[:self.M]]
+            self._upper[level - 1][neighbor] = candidates.astype(np.int32)
+
+    def _insert(self, data: np.ndarray, node: int):
+        query = np.asarray(data[node], dtype=np.float32)
+        level = int(-np.log(1.0 - self._rng.random()) * self._level_mult)
+        self.levels[node] = level
+        while len(self._upper) < level:
+            self._upper.append({})
+
+        if self.entry_point < 0:
+            self.entry_point = node
+            self.max_level = level
+            return
+
+        # 上位レイヤーは貪欲探索で入口ノードだけを絞り込む
+        entry_points = np.array([self.entry_point])
+        for lc in range(self.max_level, level, -1):
+            entry_points = self._search_layer(data, query, entry_points, 1, lc)[0]
+
+        for lc in range(min(level, self.max_level), -1, -1):
+            found, sims = self._search_layer(data, query, entry_points, self.ef_construction, lc)
+            selected = self._select_neighbors(data, found, sims, self.M0 if lc == 0 else self.M)
+            self._set_neighbors(node, lc, found[selected], sims[selected])
+            self._connect(data, node, found[selected], sims[selected], lc)
+            entry_points = found
+
+        if level > self.max_level:
+            self.entry_point = node
+            self.max_level = level
+
+    def _restore_level0_sims(self, data: np.ndarray, block_size: int = 4096):
+        """類似度を保存していないグラフについて、レイヤー0の各枠の類似度を計算し直す"""
+        self._level0_sims = np.full(self._level0.shape, -np.inf, dtype=np.float32)
+        for start in range(0, self.size, block_size):
+            end = min(start + block_size, self.size)
+            neighbors = self._level0[start:end]
+            valid = neighbors >= 0
+            vectors = np.asarray(data[start:end], dtype=np.float32)
+            neighbor_vectors = np.asarray(data[np.where(valid, neighbors, 0)], dtype=np.float32)
+            sims = np.einsum("nd,nkd->nk", vectors, neighbor_vectors)
+            self._level0_sims[start:end] = np.where(valid, sims, -np.inf)
+
+    def add_items(self, data: np.ndarray, start: int, end: int):
+        """data[start:end] の行をノードとしてグラフに追加 (start は登録済みノード数と一致させる)"""
+        if start != self.size:
+            raise ValueError(f"ノードは行番号順に追加する必要があります: {start} != {self.size}")
+        if self._level0_sims is None:
+            self._restore_level0_sims(data)
+        self._reserve(end)
+        for node in range(start, end):
+            self._insert(data, node)
+            self.size = node + 1
+
+    def _repair(self, data: np.ndarray, node: int, candidates: np.ndarray, level: int):
+        """
+        nodeの隣接を、残っている隣接と候補 (新しいノード番号、-1は無視) から挿入時と同じヒューリスティックで選び直す
+        """
+        candidates = np.concatenate([self._neighbors(node, level), candidates])
+        candidates = np.unique(candidates[candidates >= 0])
+        candidates = candidates[candidates != node]
+        sims = np.asarray(data[candidates], dtype=np.float32) @ np.asarray(data[node], dtype=np.float32)
+        order = np.argsort(-sims, kind="stable")
+        candidates, sims = candidates[order], sims[order]
+        selected = self._select_neighbors(data, candidates, sims, self.M0 if level == 0 else self.M)
+        self._set_neighbors(node, level, candidates[selected], sims[selected])
+
+    def _relink(self, data: np.ndarray, node: int):
+        """レイヤー0の隣接をすべて失ったノードを、挿入時と同じ探索でつなぎ直す"""
+        query = np.asarray(data[node], dtype=np.float32)
+        entry_points = np.array([self.entry_point])
+        for lc in range(self.max_level, 0, -1):
+            entry_points = self._search_layer(data, query, entry_points, 1, lc)[0]
+        found, sims = self._search_layer(data, query, entry_points, self.ef_construction, 0)
+        found, sims = found[found != node], sims[found != node]
+        selected = self._select_neighbors(data, found, sims, self.M0)
+        self._set_neighbors(node, 0, found[selected], sims[selected])
+        self._connect(data, node, found[selected], sims[selected], 0)
+
+    def compact(self, data: np.ndarray, keep: np.ndarray):
+        """
+        keep (残すノードの旧番号、昇順) のノードだけを残し、ノード番号を0から詰め直す
+        dataには詰め直した後の行列を渡す
+        削除したノードを隣接に持っていたノードは、削除したノードの隣接ノードから類似度の高いものを補う
+        グラフを作り直さないため、処理量は削除したノードに接していた辺の数に比例する
+        """
+        keep = np.asarray(keep, dtype=np.int64)
+        size = len(keep)
+        # 旧番号 -> 新番号 (削除したノードは-1)。末尾の-1は未使用の枠 (-1) の変換先
+        remap = np.full(self.size + 1, -1, dtype=np.int64)
+        remap[keep] = np.arange(size)
+        entry_point = int(remap[self.entry_point]) if self.entry_point >= 0 else -1
+
+        # レイヤー0: 隣接を新番号に付け替え、削除したノードへの辺は空きにする
+        old_level0 = self._level0[:self.size]
+        kept_level0 = old_level0[keep]
+        broken = (kept_level0 >= 0) & (remap[kept_level0] < 0)
+        levels = self.levels[keep]
+        level0_sims = self._level0_sims[keep] if self._level0_sims is not None else None
+
+        capacity = max(size, 1024)
+        self._level0 = np.full((capacity, self.M0), -1, dtype=np.int32)
+        self._level0[:size] = remap[kept_level0]
+        self.levels = np.zeros(capacity, dtype=np.int8)
+        self.levels[:size] = levels
+        self.size = size
+        if level0_sims is None:
+            self._restore_level0_sims(data)
+        else:
+            level0_sims[broken] = -np.inf
+            self._level0_sims = np.full((capacity, self.M0), -np.inf, dtype=np.float32)
+            self._level0_sims[:size] = level0_sims
+
+        affected = np.flatnonzero(broken.any(axis=1))
+        for node in affected.tolist():
+            removed = kept_level0[node][broken[node]]
+            self._repair(data, node, remap[old_level0[removed].ravel()], 0)
+
+        # レイヤー1以上も同様に付け替えて補う
+        for i, layer in enumerate(self._upper):
+            remapped, damaged = {}, []
+            for node, neighbors in layer.items():
+                if remap[node] < 0:
+                    continue
+                mapped = remap[neighbors]
+                remapped[int(remap[node])] = mapped[mapped >= 0].astype(np.int32)
+                if (mapped < 0).any():
+                    damaged.append((int(remap[node]), neighbors[mapped < 0]))
+            self._upper[i] = remapped
+            for node, removed in damaged:
+                self._repair(data, node, remap[np.concatenate([layer[n] for n in removed.tolist()])], i + 1)
+
+        if size == 0:
+            self.entry_point, self.max_level = -1, -1
+            self._upper = []
+            return
+        # 入口ノードを削除した場合は、残ったノードのうちレベルが最も高いものに替える
+        if entry_point < 0:
+            entry_point = int(np.argmax(self.levels[:size]))
+            self.max_level = int(self.levels[entry_point])
+            del self._upper[self.max_level:]
+        self.entry_point = entry_point
+
+        for node in affected[(self._level0[affected] < 0).all(axis=1)].tolist():
+            self._relink(data, node)
+
+    def search(
+        self,
+        data: np.ndarray,
+        query: np.ndarray,
+        k: int,
+        ef: Optional[int] = None,
+        allowed: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        正規化済みクエリに近い上位k件の (ノード番号, 類似度) を返す
+        allowed (ノード数分のbool配列) を渡した場合は、Trueのノードだけを結果に含める
+        """
+        if self.entry_point < 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+        query = np.asarray(query, dtype=np.float32)
+        entry_points = np.array([self.entry_point])
+        for lc in range(self.max_level, 0, -1):
+            entry_points = self._search_layer(data, query, entry_points, 1, lc)[0]
+
+        nodes, sims = self._search_layer(data, query, entry_points, max(ef or self.ef_search, k), 0)
+        if allowed is not None:
+            mask = allowed[nodes]
+            nodes, sims = nodes[mask], sims[mask]
+        return nodes[:k].astype(np.intp), sims[:k].astype(np.float32)
+
+    def save(self, f):
+        """グラフをnpz形式で書き出す"""
+        arrays = {
+            "params": np.array([
+                self.M, self.ef_construction, self.ef_search, self.seed,
+                self.size, self.entry_point, self.max_level
+            ], dtype=np.int64),
+            "levels": self.levels[:self.size],
+            "level0": self._level0[:self.size],
+        }
+        if self._level0_sims is not None:
+            arrays["level0_sims"] = self._level0_sims[:self.size]
+        for i, layer in enumerate(self._upper):
+            nodes = np.array(sorted(layer), dtype=np.int32)
+            lengths = np.array([len(layer[n]) for n in nodes.tolist()], dtype=np.int64)
+            arrays[f"upper{i}_nodes"] = nodes
+            arrays[f"upper{i}_offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            arrays[f"upper{i}_neighbors"] = (
+                np.concatenate([layer[n] for n in nodes.tolist()]) if len(nodes) else np.empty(0, dtype=np.int32)
+            )
+        np.savez(f, **arrays)
+
+    @classmethod
+    def load(cls, f) -> "HNSWIndex":
+        """saveで書き出したグラフを読み込む"""
+        with np.load(f) as data:
+            M, ef_construction, ef_search, seed, size, entry_point, max_level = (
+                int(v) for v in data["params"]
+            )
+            index = cls(M=M, ef_construction=ef_construction, ef_search=ef_search, seed=seed)
+            index._reserve(size)
+            index.levels[:size] = data["levels"]
+            index._level0[:size] = data["level0"]
+            if "level0_sims" in data:
+                index._level0_sims[:size] = data["level0_sims"]
+            else:
+                index._level0_sims = None
+            index.size = size
+            index.entry_point = entry_point
+            index.max_level = max_level
+
+            for i in range(max(max_level, 0)):
+                nodes = data[f"upper{i}_nodes"]
+                offsets = data[f"upper{i}_offsets"]
+                neighbors = data[f"upper{i}_neighbors"]
+                index._upper.append({
+                    int(node): neighbors[offsets[j]:offsets[j + 1]]
+                    for j, node in enumerate(nodes)
+                })
+        # 続けて追加したノードのレベルが保存前と同じ乱数列にならないようにする
+        index._rng = np.random.default_rng([seed, size])
+        return index
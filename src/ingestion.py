@@ -0,0 +1,492 @@
+import base64
+import codecs
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+from openai import BadRequestError
+
+from rate_limiter import count_tokens
+
+
+class Batch(NamedTuple):
+    """1回の埋め込みリクエスト分のチャンク"""
+    texts: List[str]
+    metadatas: List[Dict]
+    keys: List[Tuple[str, str, int]]   # (ファイル名, 内容と分割設定のsha256, ファイル内のチャンク番号)
+    tokens: List[int]                  # チャンクごとのトークン数 (chunk_fileで数えたもの)
+
+
+def read_markdown_files(
+    directory_path: str,
+    extensions: Tuple[str, ...] = ('.md', '.markdown'),
+    max_file_size: Optional[int] = None,
+    stream_threshold: Optional[int] = 64 * 1024 * 1024,
+    segment_size: int = 1024 * 1024,
+    encodings: Tuple[str, ...] = ('utf-8',)
+) -> Iterator[Tuple[str, str]]:
+    """
+    指定されたディレクトリのマークダウンファイルを1回の走査で順に読み込み、(相対パス, コンテンツ) を返すジェネレーター
+    - max_file_size (バイト) を超えるファイルは警告を出して読み飛ばす
+    - stream_threshold (バイト) を超えるファイルは全体を読み込まず、約segment_size文字ずつ
+      段落の切れ目で区切って同じ相対パスで複数回返す
+    - 文字コードは先頭のBOMと、encodingsを順に試してデコードできるかで判定する
+      cp932はほぼどのバイト列もデコードできてしまうため、Shift_JISのファイルを読む場合だけ
+      encodings=('utf-8', 'cp932') のように指定する
+      (全体を読み込むファイルは判定でデコードした結果をそのまま使い、2回デコードしない。
+      区切って返すファイルは、一部だけが返されることのないよう先に全体をデコードできるか確かめる)
+    - どちらの読み方でもデコードできないバイト列 (末尾で途切れたマルチバイト文字を含む) は誤りとし、警告を出して読み飛ばす
+    """
+    directory = Path(directory_path)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(extensions):
+                continue
+            file_path = Path(root) / name
+            relative_path = str(file_path.relative_to(directory))
+            try:
+                size = file_path.stat().st_size
+                if max_file_size is not None and size > max_file_size:
+                    print(f"警告: ファイル {file_path} は {size} バイトで上限を超えているため読み飛ばします")
+                    continue
+                with open(file_path, 'rb') as f:
+                    if stream_threshold is not None and size > stream_threshold:
+                        for segment in _read_segments(f, segment_size, encodings):
+                            yield relative_path, segment
+                    else:
+                        yield relative_path, _decode(f.read(), encodings)
+            except Exception as e:
+                print(f"警告: ファイル {file_path} の読み込み中にエラーが発生しました: {e}")
+
+
+def _candidate_encodings(head: bytes, encodings: Tuple[str, ...]) -> Tuple[str, ...]:
+    """BOMがあればその文字コード、なければencodingsを試す順に返す"""
+    if head.startswith(codecs.BOM_UTF8):
+        return ('utf-8-sig',)
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return ('utf-16',)
+    return encodings
+
+
+def _raise_if_truncated(encoding: str, error: UnicodeDecodeError):
+    """末尾で途切れたUTF-8は別の文字コードとしてデコードできても文字化けになるため、次を試さずに誤りとする"""
+    if codecs.lookup(encoding).name in ('utf-8', 'utf-8-sig') and error.reason == 'unexpected end of data':
+        raise UnicodeError(f"UTF-8のファイルの末尾でマルチバイト文字が途切れています: {error}") from error
+
+
+def _decode(data: bytes, encodings: Tuple[str, ...]) -> str:
+    """BOM、またはencodingsを順に試し、最初にデコードできた結果を返す (文字コードごとに1回だけデコードする)"""
+    candidates = _candidate_encodings(data, encodings)
+    for encoding in candidates:
+        try:
+            return codecs.decode(data, encoding)
+        except UnicodeDecodeError as e:
+            _raise_if_truncated(encoding, e)
+    raise UnicodeError(f"文字コードを判定できません (試した文字コード: {', '.join(candidates)})")
+
+
+def _detect_encoding(f, encodings: Tuple[str, ...], block_size: int) -> str:
+    """
+    ファイル全体をblock_sizeバイトずつデコードし、最後までデコードできる最初の文字コードを返す
+    1つもない場合は何も返さないうちに例外を送出する (読み終えたらファイルの先頭に戻す)
+    """
+    candidates = _candidate_encodings(f.read(block_size), encodings)
+    for encoding in candidates:
+        f.seek(0)
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            while True:
+                block = f.read(block_size)
+                decoder.decode(block, final=not block)
+                if not block:
+                    break
+        except UnicodeDecodeError as e:
+            _raise_if_truncated(encoding, e)
+            continue
+        f.seek(0)
+        return encoding
+    raise UnicodeError(f"文字コードを判定できません (試した文字コード: {', '.join(candidates)})")
+
+
+def _read_segments(f, segment_size: int, encodings: Tuple[str, ...]) -> Iterator[str]:
+    """
+    バイナリファイルを少しずつデコードし、約segment_size文字ごとに見出しか段落の切れ目で区切って返す
+    途中でデコードに失敗して一部だけが取り込まれないよう、先にファイル全体をデコードできるか確かめる
+    """
+    decoder = codecs.getincrementaldecoder(_detect_encoding(f, encodings, segment_size))()
+    buffer = ''
+    while True:
+        block = f.read(segment_size)
+        buffer += decoder.decode(block, final=not block)
+        while len(buffer) >= segment_size:
+            # 見出しの直前で区切れればそこで、なければ最後の空行で区切る
+            cut = buffer.rfind('\n\n#', segment_size // 2, segment_size)
+            if cut <= 0:
+                cut = buffer.rfind('\n\n', 0, segment_size)
+            if cut <= 0:
+                cut = buffer.rfind('\n', 0, segment_size)
+            if cut <= 0:
+                cut = segment_size
+            yield buffer[:cut]
+            buffer = buffer[cut:].lstrip('\n')
+        if not block:
+            break
+    if buffer.strip():
+        yield buffer
+
+
+def chunk_file(
+    file_path: str,
+    content: str,
+    split_text: Callable[[str], List[str]],
+    max_chunk_tokens: int = 8191,
+    ingested: Optional[Callable[[str, str], Set[int]]] = None,
+    splitter_key: str = ""
+) -> List[Tuple[str, int, Tuple[str, str, int]]]:
+    """
+    1ファイルをチャンクに分割し、(テキスト, トークン数, キー) のリストを返す
+    APIの1入力あたりの上限 (max_chunk_tokens) を超えるチャンクは分割して、同じソースの複数チャンクにする
+    キーのsha256は内容と分割設定 (splitter_key, max_chunk_tokens) から求め、設定を変えるとキーも変わる
+    ingested(ファイル名, sha256) が取り込み済みのチャンク番号の集合を返す場合は、
+    そのチャンクを飛ばして中断した取り込みを再開する (内容か設定が変わったファイルは最初から取り込む)
+    """
+    sha = hashlib.sha256(f"{splitter_key}\0{max_chunk_tokens}\0".encode('utf-8'))
+    sha.update(content.encode('utf-8'))
+    digest = sha.hexdigest()
+    done = ingested(file_path, digest) if ingested else set()
+    pieces = (piece for chunk in split_text(content) for piece in _fit_chunk(chunk, max_chunk_tokens))
+    return [
+        (text, tokens, (file_path, digest, index))
+        for index, (text, tokens) in enumerate(pieces)
+        if index not in done
+    ]
+
+
+def pack_batches(
+    chunked_files: Iterable[List[Tuple[str, int, Tuple[str, str, int]]]],
+    batch_size: int = 100,
+    max_batch_tokens: int = 100000
+) -> Iterator[Batch]:
+    """chunk_fileの結果を、1回のリクエストがbatch_size件・max_batch_tokensトークンを超えない範囲でできるだけ詰める"""
+    batch, batch_tokens = Batch([], [], [], []), 0
+    for chunks in chunked_files:
+        for text, tokens, key in chunks:
+            if batch.texts and (len(batch.texts) >= batch_size or batch_tokens + tokens > max_batch_tokens):
+                yield batch
+                batch, batch_tokens = Batch([], [], [], []), 0
+            batch.texts.append(text)
+            batch.metadatas.append({"source": key[0]})
+            batch.keys.append(key)
+            batch.tokens.append(tokens)
+            batch_tokens += tokens
+    if batch.texts:
+        yield batch
+
+
+def _fit_chunk(chunk: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+    """チャンクを (テキスト, トークン数) の列にする。上限を超える場合は文字数で等分して数え直す"""
+    tokens = count_tokens(chunk)
+    if tokens <= max_tokens or len(chunk) <= 1:
+        yield chunk, tokens
+        return
+    size = -(-len(chunk) // -(-tokens // max_tokens))
+    for start in range(0, len(chunk), size):
+        yield from _fit_chunk(chunk[start:start + size], max_tokens)
+
+
+def embed_batches(
+    embedder,
+    batches: Iterable[Batch],
+    max_in_flight: Optional[int] = None,
+    stats: Optional["StageStats"] = None
+) -> Iterator[Tuple[Batch, Optional[np.ndarray], List[Tuple[Batch, Exception]]]]:
+    """
+    バッチごとの埋め込みを並行にリクエストし、
+    完了したものから入力と同じ順序で (成功したチャンクのBatch, その埋め込み, [(失敗したチャンクのBatch, 例外)]) を返す
+    同時に投入するバッチ数はembedderのRateLimiterの現在の同時実行数に合わせる (max_in_flightを指定した場合はそれが上限)
+    入力が原因で拒否されたバッチ (400) は二分して再試行し、問題のあるチャンクだけを失敗として返す
+    embedder.embed_documents(texts, tokens) にはBatchのトークン数を渡し、RateLimiter用に数え直させない
+    """
+    limiter = getattr(embedder, "rate_limiter", None)
+    max_workers = 2 * limiter.max_concurrency if limiter is not None else (max_in_flight or 4)
+    with ThreadPoolExecutor(max_workers=min(max_workers, max_in_flight or max_workers)) as executor:
+        pending = deque()
+        for batch in batches:
+            pending.append((batch, executor.submit(_embed_timed, embedder, batch.texts, batch.tokens, stats)))
+            # 先頭のバッチが終わるまで次のリクエストを出さず、同時実行数と結果の滞留を抑える
+            while len(pending) >= _submission_window(limiter, max_in_flight):
+                yield _batch_result(*pending.popleft())
+        while pending:
+            yield _batch_result(*pending.popleft())
+
+
+def _submission_window(limiter, max_in_flight: Optional[int]) -> int:
+    """
+    同時に投入しておくバッチ数
+    RateLimiterの同時実行数 (429で半減し、成功するたびに増える) の2倍とし、先頭のバッチを待つ間も
+    空いた枠にすぐ次のリクエストを出せるようにする (実際の同時実行数はRateLimiterが抑える)
+    """
+    if limiter is None:
+        return max_in_flight or 4
+    window = 2 * max(1, int(limiter.concurrency))
+    return min(window, max_in_flight) if max_in_flight else window
+
+
+def _embed_timed(embedder, texts: List[str], tokens: List[int], stats: Optional["StageStats"]):
+    start = time.perf_counter()
+    embeddings, failures = _embed_bisect(embedder, texts, tokens)
+    if stats is not None:
+        stats.add(len(texts) - sum(len(rows) for rows, _ in failures), time.perf_counter() - start)
+    return embeddings, failures
+
+
+def _embed_bisect(
+    embedder,
+    texts: List[str],
+    tokens: List[int]
+) -> Tuple[Optional[np.ndarray], List[Tuple[List[int], Exception]]]:
+    """
+    textsを埋め込み、(成功した行の埋め込み, [(失敗した行番号のリスト, 例外)]) を返す
+    tokensはテキストごとのトークン数で、RateLimiterに渡すためにテキストと一緒に分割する
+    """
+    try:
+        return np.asarray(embedder.embed_documents(texts, tokens), dtype=np.float32), []
+    except BadRequestError as e:
+        if len(texts) == 1:
+            return None, [([0], e)]
+    except Exception as e:
+        # レート制限や接続エラーは再試行済みなので、分割してもリクエストが増えるだけ
+        return None, [(list(range(len(texts))), e)]
+
+    mid = len(texts) // 2
+    left, left_failures = _embed_bisect(embedder, texts[:mid], tokens[:mid])
+    right, right_failures = _embed_bisect(embedder, texts[mid:], tokens[mid:])
+    failures = left_failures + [([row + mid for row in rows], e) for rows, e in right_failures]
+    parts = [part for part in (left, right) if part is not None]
+    return (np.concatenate(parts) if parts else None), failures
+
+
+def _select(batch: Batch, rows: List[int]) -> Batch:
+    return Batch(*([column[row] for row in rows] for column in batch))
+
+
+def _batch_result(batch: Batch, future):
+    embeddings, failures = future.result()
+    failed_rows = {row for rows, _ in failures for row in rows}
+    succeeded = _select(batch, [row for row in range(len(batch.texts)) if row not in failed_rows])
+    return succeeded, embeddings, [(_select(batch, rows), e) for rows, e in failures]
+
+
+def decode_embeddings(data) -> np.ndarray:
+    """
+    encoding_format="base64" で受け取った埋め込みを、float32の行列に直接デコードする
+    (1536個のPythonのfloatのリストを経由しないため、メモリとCPUを大きく減らせる)
+    """
+    embeddings = None
+    for item in data:
+        vector = np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32)
+        if embeddings is None:
+            embeddings = np.empty((len(data), len(vector)), dtype=np.float32)
+        embeddings[item.index] = vector
+    return embeddings if embeddings is not None else np.empty((0, 0), dtype=np.float32)
+
+
+class StageStats:
+    """パイプラインの1段の処理件数と処理時間 (並行に動くスレッドの合計)"""
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy += seconds
+
+
+class PipelineStats:
+    """run_pipelineの段ごとのカウンター"""
+    def __init__(self):
+        self.read = StageStats("read", "ファイル")
+        self.chunk = StageStats("chunk", "チャンク")
+        self.embed = StageStats("embed", "チャンク")
+        self.write = StageStats("write", "チャンク")
+        self.failed = 0
+        self._started = time.monotonic()
+        self._finished = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self._finished or time.monotonic()) - self._started
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        lines = [f"取り込み完了: {elapsed:.1f}秒 (失敗したチャンク: {self.failed}件)"]
+        for stage in (self.read, self.chunk, self.embed, self.write):
+            lines.append(
+                f"  {stage.name}: {stage.items}{stage.unit} "
+                f"({stage.items / elapsed:.1f}{stage.unit}/秒, 処理時間の合計 {stage.busy:.1f}秒)"
+            )
+        return "\n".join(lines)
+
+
+class _StageError:
+    """前段のスレッドで発生した例外を後段に伝えるためのラッパー"""
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """キューに空きができるまで待って追加する (中止された場合はFalse)"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _drain(q: queue.Queue, stop: threading.Event) -> Iterator:
+    """前段が_DONEを送るまでキューの中身を返す (前段の例外はここで送出する)"""
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _DONE:
+            return
+        if isinstance(item, _StageError):
+            raise item.error
+        yield item
+
+
+def _read_stage(markdown_files, files_q: queue.Queue, stats: PipelineStats, stop: threading.Event):
+    try:
+        files = iter(markdown_files)
+        while True:
+            start = time.perf_counter()
+            item = next(files, _DONE)   # ジェネレーターの場合はここでファイルが読まれる
+            if item is _DONE:
+                break
+            stats.read.add(1, time.perf_counter() - start)
+            if not _put(files_q, item, stop):
+                return
+        _put(files_q, _DONE, stop)
+    except BaseException as e:
+        _put(files_q, _StageError(e), stop)
+
+
+def _chunk_stage(
+    files_q: queue.Queue,
+    batch_q: queue.Queue,
+    split_text,
+    chunk_workers: int,
+    batch_size: int,
+    max_batch_tokens: int,
+    max_chunk_tokens: int,
+    ingested,
+    splitter_key: str,
+    stats: PipelineStats,
+    stop: threading.Event
+):
+    def chunk(file_path, content):
+        start = time.perf_counter()
+        chunks = chunk_file(file_path, content, split_text, max_chunk_tokens, ingested, splitter_key)
+        stats.chunk.add(len(chunks), time.perf_counter() - start)
+        return chunks
+
+    def chunked_files():
+        # ファイルの順序を保ったまま、最大chunk_workers件を並行に分割する
+        with ThreadPoolExecutor(max_workers=chunk_workers) as executor:
+            pending = deque()
+            for file_path, content in _drain(files_q, stop):
+                pending.append(executor.submit(chunk, file_path, content))
+                if len(pending) >= 2 * chunk_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    try:
+        for batch in pack_batches(chunked_files(), batch_size, max_batch_tokens):
+            if not _put(batch_q, batch, stop):
+                return
+        _put(batch_q, _DONE, stop)
+    except BaseException as e:
+        _put(batch_q, _StageError(e), stop)
+
+
+def run_pipeline(
+    markdown_files: Iterable[Tuple[str, str]],
+    split_text: Callable[[str], List[str]],
+    embedder,
+    write: Callable[[Batch, np.ndarray], None],
+    batch_size: int = 100,
+    max_batch_tokens: int = 100000,
+    max_chunk_tokens: int = 8191,
+    ingested: Optional[Callable[[str, str], Set[int]]] = None,
+    splitter_key: str = "",
+    chunk_workers: int = 4,
+    max_in_flight: Optional[int] = None,
+    queue_size: int = 16
+) -> PipelineStats:
+    """
+    ファイルの読み込み → チャンク分割 → 埋め込み → 書き込み をパイプラインで並行に実行する
+    - 読み込み: 1スレッドでmarkdown_filesを順に取り出す
+    - チャンク分割: chunk_workers個のスレッドで分割し、リクエスト単位のBatchに詰める
+    - 埋め込み: embed_batchesでRateLimiterの同時実行数 (max_in_flightが上限) に合わせて並行にリクエストする
+      入力が原因で拒否されたバッチは二分して再試行し、失敗するのは問題のあるチャンクだけになる
+    - 書き込み: 呼び出し元のスレッドだけがwrite(Batch, 埋め込み) を呼ぶ
+    段の間はqueue_size件までのキューでつなぎ、後段が詰まると前段が待つ (全体の速度は最も遅い段で決まる)
+    ingestedとsplitter_key (split_textの設定を表す文字列) はchunk_fileにそのまま渡す
+    """
+    stats = PipelineStats()
+    stop = threading.Event()
+    files_q = queue.Queue(maxsize=queue_size)
+    batch_q = queue.Queue(maxsize=queue_size)
+    threads = [
+        threading.Thread(target=_read_stage, args=(markdown_files, files_q, stats, stop), daemon=True),
+        threading.Thread(
+            target=_chunk_stage,
+            args=(files_q, batch_q, split_text, chunk_workers, batch_size, max_batch_tokens,
+                  max_chunk_tokens, ingested, splitter_key, stats, stop),
+            daemon=True
+        ),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for batch, embeddings, failures in embed_batches(embedder, _drain(batch_q, stop), max_in_flight, stats.embed):
+            for failed, error in failures:
+                stats.failed += len(failed.texts)
+                print(f"警告: チャンク{len(failed.texts)}件 ({failed.metadatas[0]['source']} など) の埋め込みに失敗しました: {error}")
+            if not batch.texts:
+                continue
+            start = time.perf_counter()
+            try:
+                write(batch, embeddings)
+            except Exception as e:
+                stats.failed += len(batch.texts)
+                print(f"警告: バッチ処理中にエラーが発生しました: {e}")
+                continue
+            stats.write.add(len(batch.texts), time.perf_counter() - start)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+        stats._finished = time.monotonic()
+    return stats
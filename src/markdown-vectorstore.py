@@ -1,35 +1,8 @@
 from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import AzureOpenAIEmbeddings
 from langchain.text_splitter import MarkdownTextSplitter
-from pathlib import Path
 import os
-
-def read_markdown_files(directory_path):
-    """
-    指定されたディレクトリから全てのマークダウンファイルを読み込む
-
-    Parameters:
-        directory_path (str): マークダウンファイルのあるディレクトリパス
-
-    Returns:
-        list: (ファイル名, コンテンツ) のタプルのリスト
-    """
-    markdown_files = []
-    directory = Path(directory_path)
-    
-    # .mdと.markdownの両方のファイルを検索
-    for extension in ['*.md', '*.markdown']:
-        for file_path in directory.rglob(extension):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    # ファイル名（パスを含む）とコンテンツを保存
-                    relative_path = str(file_path.relative_to(directory))
-                    markdown_files.append((relative_path, content))
-            except Exception as e:
-                print(f"警告: ファイル {file_path} の読み込み中にエラーが発生しました: {e}")
-    
-    return markdown_files
+from ingestion import read_markdown_files
 
 def create_vectorstore_from_markdown_directory(
     directory_path,
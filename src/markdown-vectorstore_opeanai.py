@@ -1,72 +1,11 @@
 from langchain_community.vectorstores import FAISS
-from pathlib import Path
 import os
 import numpy as np
 from openai import AzureOpenAI
 from tenacity import retry, stop_after_attempt, wait_exponential
-import time
-
-class AzureOpenAIEmbedder:
-    """Azure OpenAIを使用して埋め込みを生成するクラス"""
-    def __init__(self, client=None, model=None, timeout=60):
-        self.client = client or AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        )
-        self.model = model or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        self.timeout = timeout
-
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        reraise=True
-    )
-    def embed_documents(self, texts):
-        """
-        テキストの配列を埋め込みベクトルに変換
-        """
-        try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=texts,
-                timeout=self.timeout
-            )
-            return [embedding.embedding for embedding in response.data]
-        except Exception as e:
-            print(f"埋め込み生成中にエラーが発生: {e}")
-            raise
-
-    def embed_query(self, text):
-        """
-        単一のクエリテキストを埋め込みベクトルに変換
-        """
-        return self.embed_documents([text])[0]
-
-def read_markdown_files(directory_path):
-    """
-    指定されたディレクトリから全てのマークダウンファイルを読み込む
-
-    Parameters:
-        directory_path (str): マークダウンファイルのあるディレクトリパス
-
-    Returns:
-        list: (ファイル名, コンテンツ) のタプルのリスト
-    """
-    markdown_files = []
-    directory = Path(directory_path)
-    
-    for extension in ['*.md', '*.markdown']:
-        for file_path in directory.rglob(extension):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    relative_path = str(file_path.relative_to(directory))
-                    markdown_files.append((relative_path, content))
-            except Exception as e:
-                print(f"警告: ファイル {file_path} の読み込み中にエラーが発生しました: {e}")
-    
-    return markdown_files
+from embedding_cache import EmbeddingCache
+from embedder import AzureOpenAIEmbedder
+from ingestion import read_markdown_files, run_pipeline
 
 def create_vectorstore_from_markdown_directory(
     directory_path,
@@ -74,7 +13,11 @@ def create_vectorstore_from_markdown_directory(
     chunk_size=1000,
     chunk_overlap=200,
     include_metadata=True,
-    batch_size=100
+    batch_size=100,
+    max_batch_tokens=100000,
+    embedding_cache_path="embedding_cache.db",
+    max_in_flight=None,
+    chunk_workers=4
 ):
     """
     ディレクトリ内の全マークダウンファイルからFAISSベクトルストアを作成する
@@ -85,7 +28,11 @@ def create_vectorstore_from_markdown_directory(
         chunk_size (int): チャンクサイズ
         chunk_overlap (int): チャンクオーバーラップ
         include_metadata (bool): メタデータを含めるかどうか
-        batch_size (int): 一度に処理するテキストの数
+        batch_size (int): 1回のリクエストで送るテキストの最大数
+        max_batch_tokens (int): 1回のリクエストで送るトークン数の上限
+        embedding_cache_path (str): 埋め込みキャッシュのパス (Noneでキャッシュしない)
+        max_in_flight (int): 同時に実行する埋め込みリクエストの上限 (Noneでレートリミッターの同時実行数に合わせる)
+        chunk_workers (int): チャンク分割を並行に行うスレッド数
 
     Returns:
         FAISS: 作成されたベクトルストア
@@ -93,7 +40,8 @@ def create_vectorstore_from_markdown_directory(
     from langchain.text_splitter import MarkdownTextSplitter
     
     # 埋め込みモデルの初期化
-    embedder = AzureOpenAIEmbedder(client=client)
+    cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    embedder = AzureOpenAIEmbedder(client=client, cache=cache)
 
     # テキストスプリッターの設定
     text_splitter = MarkdownTextSplitter(
@@ -101,85 +49,32 @@ def create_vectorstore_from_markdown_directory(
         chunk_overlap=chunk_overlap
     )
 
-    markdown_files = read_markdown_files(directory_path)
-    
     vectorstore = None
-    current_texts = []
-    current_metadatas = []
-    
-    for file_path, content in markdown_files:
-        chunks = text_splitter.split_text(content)
-        
-        for chunk in chunks:
-            current_texts.append(chunk)
-            if include_metadata:
-                current_metadatas.append({"source": file_path})
-            
-            if len(current_texts) >= batch_size:
-                try:
-                    embeddings = embedder.embed_documents(current_texts)
-                    
-                    if vectorstore is None:
-                        if include_metadata:
-                            vectorstore = FAISS.from_embeddings(
-                                text_embeddings=list(zip(current_texts, embeddings)),
-                                embedding=embedder,
-                                metadatas=current_metadatas
-                            )
-                        else:
-                            vectorstore = FAISS.from_embeddings(
-                                text_embeddings=list(zip(current_texts, embeddings)),
-                                embedding=embedder
-                            )
-                    else:
-                        if include_metadata:
-                            vectorstore.add_embeddings(
-                                text_embeddings=list(zip(current_texts, embeddings)),
-                                metadatas=current_metadatas
-                            )
-                        else:
-                            vectorstore.add_embeddings(
-                                text_embeddings=list(zip(current_texts, embeddings))
-                            )
-                    
-                    current_texts = []
-                    current_metadatas = []
-                    time.sleep(1)  # レート制限を避けるための待機
-                    
-                except Exception as e:
-                    print(f"警告: バッチ処理中にエラーが発生しました: {e}")
-                    current_texts = []
-                    current_metadatas = []
-    
-    # 残りのテキストを処理
-    if current_texts:
-        try:
-            embeddings = embedder.embed_documents(current_texts)
-            
-            if vectorstore is None:
-                if include_metadata:
-                    vectorstore = FAISS.from_embeddings(
-                        text_embeddings=list(zip(current_texts, embeddings)),
-                        embedding=embedder,
-                        metadatas=current_metadatas
-                    )
-                else:
-                    vectorstore = FAISS.from_embeddings(
-                        text_embeddings=list(zip(current_texts, embeddings)),
-                        embedding=embedder
-                    )
-            else:
-                if include_metadata:
-                    vectorstore.add_embeddings(
-                        text_embeddings=list(zip(current_texts, embeddings)),
-                        metadatas=current_metadatas
-                    )
-                else:
-                    vectorstore.add_embeddings(
-                        text_embeddings=list(zip(current_texts, embeddings))
-                    )
-        except Exception as e:
-            print(f"警告: 最終バッチの処理中にエラーが発生しました: {e}")
+
+    def write(batch, embeddings):
+        nonlocal vectorstore
+        text_embeddings = list(zip(batch.texts, embeddings))
+        metadatas = batch.metadatas if include_metadata else None
+        if vectorstore is None:
+            vectorstore = FAISS.from_embeddings(
+                text_embeddings=text_embeddings,
+                embedding=embedder,
+                metadatas=metadatas
+            )
+        else:
+            vectorstore.add_embeddings(text_embeddings=text_embeddings, metadatas=metadatas)
+
+    stats = run_pipeline(
+        read_markdown_files(directory_path),
+        text_splitter.split_text,
+        embedder,
+        write,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        chunk_workers=chunk_workers,
+        max_in_flight=max_in_flight
+    )
+    print(stats.summary())
 
     return vectorstore
 
@@ -0,0 +1,174 @@
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    テキストのトークン数を数える
+    tiktokenがあればcl100k_base (text-embedding-ada-002 / 3系の埋め込みモデルと同じ) で数え、
+    なければUTF-8のバイト数/3 (日本語は1文字≒1トークン、英語は多めになる) で見積もる
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text.encode('utf-8')) // 3 + 1
+
+
+def estimate_tokens(texts: Sequence[str]) -> int:
+    """リクエストのトークン数 (実際の残量はレスポンスヘッダーで補正する)"""
+    return sum(count_tokens(text) for text in texts)
+
+
+class _TokenBucket:
+    """1分あたりの上限をcapacityとし、毎秒capacity/60ずつ補充されるバケット"""
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.capacity / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        # 上限を超えるリクエストはバケットが満杯になった時点で通す
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) * 60 / self.capacity)
+
+
+class RateLimiter:
+    """
+    Azure OpenAIへのリクエストの流量を制御する
+    - 1分あたりのリクエスト数 (RPM) とトークン数 (TPM) をトークンバケットで制限する
+    - 429のRetry-Afterに従って全スレッドのリクエストを止め、残量ヘッダーでバケットを補正する
+    - 同時実行数をAIMDで調整する (成功ごとに少しずつ増やし、429で半分にする)
+    同じデプロイメントの上限はプロセス全体で共有されるため、通常は shared() で取得して使う
+    """
+    _shared: Dict[str, "RateLimiter"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        initial_concurrency: int = 4,
+        max_concurrency: int = 32,
+        max_retries: int = 6
+    ):
+        self._requests = _TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._tokens = _TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.concurrency = float(initial_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def shared(cls, key: str, **kwargs) -> "RateLimiter":
+        """keyごとにプロセスで1つのRateLimiterを返す (kwargsは最初の作成時だけ使う)"""
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(**kwargs)
+            return cls._shared[key]
+
+    def acquire(self, tokens: int = 0):
+        """同時実行数・RPM・TPM・Retry-Afterのすべてが許すまで待ってから枠を確保する"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = self._paused_until - now
+                for bucket, amount in ((self._requests, 1), (self._tokens, tokens)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait = max(wait, bucket.wait_time(amount))
+                if self._in_flight >= int(self.concurrency):
+                    # 完了時のnotifyで起こされるが、止まったままにならないよう上限を設ける
+                    wait = max(wait, 1.0)
+                elif wait <= 0:
+                    break
+                self._cond.wait(wait)
+
+            self._in_flight += 1
+            if self._requests is not None:
+                self._requests.level -= 1
+            if self._tokens is not None:
+                self._tokens.level -= min(tokens, self._tokens.capacity)
+
+    def release(self, headers=None, rate_limited: bool = False, succeeded: bool = True):
+        """リクエストの完了を記録し、レスポンスヘッダーの残量・Retry-Afterを反映する"""
+        with self._cond:
+            self._in_flight -= 1
+            if rate_limited:
+                self.concurrency = max(1.0, self.concurrency / 2)
+                retry_after = self._retry_after(headers)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            elif succeeded:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._sync_remaining(headers)
+            self._cond.notify_all()
+
+    @staticmethod
+    def _retry_after(headers, default: float = 1.0) -> float:
+        if headers is None:
+            return default
+        for name, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+            value = headers.get(name)
+            if value is not None:
+                try:
+                    return float(value) * scale
+                except ValueError:
+                    pass  # HTTP日付形式は使われないため既定値で待つ
+        return default
+
+    def _sync_remaining(self, headers):
+        """x-ratelimit-remaining-* ヘッダーの値がバケットの残量より少なければ合わせる"""
+        if headers is None:
+            return
+        for bucket, name in ((self._requests, 'x-ratelimit-remaining-requests'),
+                             (self._tokens, 'x-ratelimit-remaining-tokens')):
+            value = headers.get(name)
+            if bucket is not None and value is not None:
+                try:
+                    bucket.level = min(bucket.level, float(value))
+                except ValueError:
+                    pass
+
+    def call(self, request: Callable, tokens: int = 0):
+        """
+        requestを流量制限の下で実行し、結果を返す
+        requestは headers 属性を持つレスポンスを返す関数 (openaiの with_raw_response) とする
+        429はRetry-Afterだけ待って、接続エラー・タイムアウト・5xxは指数的に待って再試行する
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            try:
+                response = request()
+            except RateLimitError as e:
+                self.release(e.response.headers, rate_limited=True)
+                if attempt == self.max_retries:
+                    raise
+                continue
+            except (APIConnectionError, APITimeoutError, InternalServerError):
+                self.release(succeeded=False)
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+                continue
+            except BaseException:
+                self.release(succeeded=False)
+                raise
+            self.release(getattr(response, 'headers', None))
+            return response
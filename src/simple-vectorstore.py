@@ -1,139 +1,241 @@
-from pathlib import Path
 import numpy as np
-import json
 import os
-from typing import List, Dict, Tuple, Optional
+from typing import List, Dict, Tuple, Optional, Union
 from openai import AzureOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
 import pickle
+from hnsw_index import HNSWIndex
+from binary_index import BinarySignIndex
+from vector_storage import VectorStoreBase, save_optional
+from embedding_cache import EmbeddingCache
+from embedder import AzureOpenAIEmbedder
+from ingestion import read_markdown_files, run_pipeline
 
-class SimpleVectorStore:
-    def __init__(self):
-        self.vectors = []        # 埋め込みベクトルを保存
-        self.texts = []          # 元のテキストを保存
-        self.metadatas = []      # メタデータを保存
+class SimpleVectorStore(VectorStoreBase):
+    def __init__(self, initial_capacity: int = 1024, compaction_threshold: float = 0.3):
+        super().__init__(initial_capacity, compaction_threshold)
+        self._source_rows = None # メタデータのsourceごとの行番号 (delete_by_sourceの初回呼び出しで作成)
+        self.hnsw_index = None   # HNSWグラフインデックス (build_hnsw_indexで作成)
+        self.binary_index = None # バイナリコードの前段フィルタ (build_binary_indexで作成)
 
-    def add_vectors(self, vectors: List[List[float]], texts: List[str], metadatas: Optional[List[Dict]] = None):
-        """ベクトル、テキスト、メタデータを追加"""
+    def add_vectors(
+        self,
+        vectors: Union[np.ndarray, List[List[float]]],
+        texts: List[str],
+        metadatas: Optional[List[Dict]] = None
+    ) -> List[int]:
+        """
+        ベクトル、テキスト、メタデータを追加し、追加したドキュメントのIDを返す
+        vectorsがfloat32のndarrayの場合はコピーせず、正規化した結果を行列に直接書き込む
+        """
         if not metadatas:
             metadatas = [{} for _ in texts]
-        
-        for vector, text, metadata in zip(vectors, texts, metadatas):
-            self.vectors.append(vector)
-            self.texts.append(text)
-            self.metadatas.append(metadata)
-
-    def similarity_search(self, query_vector: List[float], k: int = 5) -> List[Tuple[Dict, float]]:
-        """コサイン類似度に基づく検索を実行"""
-        if not self.vectors:
+
+        if len(texts) == 0:
             return []
 
-        # numpy配列に変換
-        vectors = np.array(self.vectors)
-        query_vector = np.array(query_vector)
+        start_row, ids = self._append_rows(vectors, texts, metadatas)
+        if self._source_rows is not None:
+            self._index_sources(metadatas, start_row)
+        if self.hnsw_index is not None:
+            self.hnsw_index.add_items(self.vectors, start_row, self._size)
+        if self.binary_index is not None:
+            self.binary_index.add(self._matrix[start_row:self._size])
+        return ids.tolist()
 
-        # コサイン類似度を計算
-        similarities = np.dot(vectors, query_vector) / (
-            np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
-        )
+    def similarity_search(
+        self,
+        query_vector: List[float],
+        k: int = 5,
+        exact: bool = False,
+        ef_search: Optional[int] = None
+    ) -> List[Tuple[Dict, float]]:
+        """
+        コサイン類似度に基づく検索を実行
+        HNSWインデックス作成済みの場合はグラフ探索による近似検索、
+        バイナリインデックス作成済みの場合はハミング距離で絞った候補だけを走査する (exact=Trueで全件走査)
+        削除済みのドキュメントは結果に含めない
+        """
+        if self._size == 0:
+            return []
+
+        query_vector = self._normalize(np.asarray(query_vector, dtype=np.float32))
+        deleted = self._deleted_rows()
+        if self.hnsw_index is not None and not exact:
+            allowed = None if deleted is None else ~deleted
+            rows, scores = self.hnsw_index.search(self.vectors, query_vector, k, ef_search, allowed)
+            return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+
+        if self.binary_index is not None and not exact:
+            rows = self.binary_index.candidates(
+                query_vector, max(k, self.binary_index.n_candidates),
+                allowed=None if deleted is None else ~deleted
+            )
+            similarities = self.vectors[rows] @ query_vector
+            top_k_indices = self._top_k_indices(similarities, k)
+            return [
+                (self._document(rows[idx]), float(similarities[idx])) for idx in top_k_indices
+            ]
+
+        # 格納済みの行は正規化済みなので、行列ベクトル積1回でコサイン類似度が求まる
+        similarities = self.vectors @ query_vector
+        if deleted is not None:
+            similarities[deleted] = -np.inf
 
         # 上位k件のインデックスを取得
-        top_k_indices = np.argsort(similarities)[-k:][::-1]
+        top_k_indices = self._top_k_indices(similarities, k)
+        if deleted is not None:
+            top_k_indices = top_k_indices[~deleted[top_k_indices]]
 
         # 結果を作成
+        return [(self._document(idx), float(similarities[idx])) for idx in top_k_indices]
+
+    def similarity_search_batch(
+        self,
+        query_matrix: List[List[float]],
+        k: int = 5,
+        block_size: int = 256
+    ) -> List[List[Tuple[Dict, float]]]:
+        """
+        複数クエリをまとめて検索し、クエリごとに similarity_search と同じ形式の結果を返す
+        block_size件ずつ1回の行列積で類似度を計算し、上位k件を行ごとにベクトル化して選ぶ
+        """
+        query_matrix = np.atleast_2d(np.asarray(query_matrix, dtype=np.float32))
+        if self._size == 0:
+            return [[] for _ in range(len(query_matrix))]
+
+        deleted = self._deleted_rows()
         results = []
-        for idx in top_k_indices:
-            doc = {
-                "page_content": self.texts[idx],
-                "metadata": self.metadatas[idx]
-            }
-            results.append((doc, float(similarities[idx])))
+        for start in range(0, len(query_matrix), block_size):
+            queries = self._normalize(query_matrix[start:start + block_size])
+            similarities = queries @ self.vectors.T
+            if deleted is not None:
+                similarities[:, deleted] = -np.inf
+            top_k_indices = self._top_k_indices(similarities, k)
+            top_k_scores = np.take_along_axis(similarities, top_k_indices, axis=1)
+
+            for indices, scores in zip(top_k_indices, top_k_scores):
+                results.append([
+                    (self._document(idx), float(score))
+                    for idx, score in zip(indices, scores)
+                    if score > -np.inf
+                ])
 
         return results
 
+    def build_hnsw_index(
+        self,
+        M: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 128,
+        seed: int = 0
+    ) -> HNSWIndex:
+        """
+        格納済みベクトルからHNSWインデックスを作成
+        以降の add_vectors で追加した行もグラフに登録される
+        """
+        index = HNSWIndex(M=M, ef_construction=ef_construction, ef_search=ef_search, seed=seed)
+        index.add_items(self.vectors, 0, self._size)
+        self.hnsw_index = index
+        return index
+
+    def build_binary_index(self, n_candidates: int = 1000) -> BinarySignIndex:
+        """
+        格納済みベクトルの符号ビットからバイナリインデックスを作成
+        検索時はハミング距離の小さいn_candidates件だけをコサイン類似度で再スコアリングする
+        """
+        index = BinarySignIndex(n_candidates=n_candidates)
+        index.add(self.vectors)
+        self.binary_index = index
+        return index
+
+    def _index_sources(self, metadatas: List[Dict], start_row: int):
+        for row, metadata in enumerate(metadatas, start_row):
+            self._source_rows.setdefault(metadata.get("source"), []).append(row)
+
+    def delete_by_source(self, source: Union[str, List[str]]) -> int:
+        """
+        メタデータのsource (ファイルパスなど) が一致するドキュメントを削除
+        sourceごとの行番号は初回呼び出し時に作成し、以降は追加のたびに更新する
+        """
+        if self._source_rows is None:
+            self._source_rows = {}
+            self._index_sources(list(self.metadatas), 0)
+        if isinstance(source, str):
+            source = [source]
+        rows = [row for value in source for row in self._source_rows.get(value, [])]
+        return self._delete_rows(rows)
+
+    def _compact_indexes(self, indices_to_keep: np.ndarray):
+        self._source_rows = None
+        if self.binary_index is not None:
+            self.binary_index.codes = self.binary_index.codes[indices_to_keep]
+        # HNSWグラフは作り直さず、ノード番号を付け替えて削除した行への辺を補修する
+        if self.hnsw_index is not None:
+            self.hnsw_index.compact(self.vectors, indices_to_keep)
+
     def save(self, path: str):
-        """ベクトルストアをファイルに保存"""
-        data = {
-            'vectors': self.vectors,
-            'texts': self.texts,
-            'metadatas': self.metadatas
-        }
-        with open(path, 'wb') as f:
-            pickle.dump(data, f)
+        """
+        ベクトルストアをディレクトリ形式で保存
+        vectors.npy (正規化済みfloat32行列), texts.bin + texts_offsets.npy,
+        metadatas.jsonl + metadatas_offsets.npy, store.json で構成される
+        """
+        self._save_rows(path)
+        hnsw = self.hnsw_index
+        save_optional(os.path.join(path, "hnsw.npz"), hnsw.save if hnsw is not None else None)
+
+        binary = self.binary_index
+        save_optional(os.path.join(path, "binary.npz"), binary.save if binary is not None else None)
+        self._save_info(path)
 
     @classmethod
-    def load(cls, path: str):
-        """ファイルからベクトルストアを読み込み"""
+    def load(cls, path: str, mmap: bool = True):
+        """
+        ディレクトリからベクトルストアを読み込み
+        mmap=Trueの場合、ベクトル・テキスト・メタデータはアクセスされた部分だけがページインされる
+        旧形式のpickleファイルを指定した場合はそのまま読み込む
+        """
+        if os.path.isfile(path):
+            return cls._load_pickle(path)
+
+        store = cls()
+        store._load_rows(path, mmap)
+
+        hnsw_path = os.path.join(path, "hnsw.npz")
+        if os.path.exists(hnsw_path):
+            store.hnsw_index = HNSWIndex.load(hnsw_path)
+
+        binary_path = os.path.join(path, "binary.npz")
+        if os.path.exists(binary_path):
+            store.binary_index = BinarySignIndex.load(binary_path)
+        return store
+
+    @classmethod
+    def _load_pickle(cls, path: str):
+        """旧形式 (pickle) のファイルからベクトルストアを読み込み"""
         with open(path, 'rb') as f:
             data = pickle.load(f)
         
         store = cls()
-        store.vectors = data['vectors']
-        store.texts = data['texts']
-        store.metadatas = data['metadatas']
+        # 旧形式 (list of list) の保存データもそのまま読み込める
+        store.add_vectors(data['vectors'], data['texts'], data['metadatas'])
         return store
 
-class AzureOpenAIEmbedder:
-    """Azure OpenAIを使用して埋め込みを生成するクラス"""
-    def __init__(self, client=None, model=None, timeout=60):
-        self.client = client or AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        )
-        self.model = model or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        self.timeout = timeout
-
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        reraise=True
-    )
-    def embed_documents(self, texts):
-        """テキストの配列を埋め込みベクトルに変換"""
-        try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=texts,
-                timeout=self.timeout
-            )
-            return [embedding.embedding for embedding in response.data]
-        except Exception as e:
-            print(f"埋め込み生成中にエラーが発生: {e}")
-            raise
-
-    def embed_query(self, text):
-        """単一のクエリテキストを埋め込みベクトルに変換"""
-        return self.embed_documents([text])[0]
-
-def read_markdown_files(directory_path):
-    """指定されたディレクトリから全てのマークダウンファイルを読み込む"""
-    markdown_files = []
-    directory = Path(directory_path)
-    
-    for extension in ['*.md', '*.markdown']:
-        for file_path in directory.rglob(extension):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    relative_path = str(file_path.relative_to(directory))
-                    markdown_files.append((relative_path, content))
-            except Exception as e:
-                print(f"警告: ファイル {file_path} の読み込み中にエラーが発生しました: {e}")
-    
-    return markdown_files
-
 def create_vectorstore_from_markdown_directory(
     directory_path,
     client=None,
     chunk_size=1000,
     chunk_overlap=200,
-    batch_size=100
+    batch_size=100,
+    max_batch_tokens=100000,
+    embedding_cache_path="embedding_cache.db",
+    max_in_flight=None,
+    chunk_workers=4
 ):
     """ディレクトリ内の全マークダウンファイルからベクトルストアを作成"""
     from langchain.text_splitter import MarkdownTextSplitter
     
-    embedder = AzureOpenAIEmbedder(client=client)
+    cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    embedder = AzureOpenAIEmbedder(client=client, cache=cache)
     vectorstore = SimpleVectorStore()
 
     # テキストスプリッターの設定
@@ -142,38 +244,20 @@ def create_vectorstore_from_markdown_directory(
         chunk_overlap=chunk_overlap
     )
 
-    markdown_files = read_markdown_files(directory_path)
-    
-    current_texts = []
-    current_metadatas = []
-    
-    for file_path, content in markdown_files:
-        chunks = text_splitter.split_text(content)
-        
-        for chunk in chunks:
-            current_texts.append(chunk)
-            current_metadatas.append({"source": file_path})
-            
-            if len(current_texts) >= batch_size:
-                try:
-                    embeddings = embedder.embed_documents(current_texts)
-                    vectorstore.add_vectors(embeddings, current_texts, current_metadatas)
-                    
-                    current_texts = []
-                    current_metadatas = []
-                    
-                except Exception as e:
-                    print(f"警告: バッチ処理中にエラーが発生しました: {e}")
-                    current_texts = []
-                    current_metadatas = []
-    
-    # 残りのテキストを処理
-    if current_texts:
-        try:
-            embeddings = embedder.embed_documents(current_texts)
-            vectorstore.add_vectors(embeddings, current_texts, current_metadatas)
-        except Exception as e:
-            print(f"警告: 最終バッチの処理中にエラーが発生しました: {e}")
+    def write(batch, embeddings):
+        vectorstore.add_vectors(embeddings, batch.texts, batch.metadatas)
+
+    stats = run_pipeline(
+        read_markdown_files(directory_path),
+        text_splitter.split_text,
+        embedder,
+        write,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        chunk_workers=chunk_workers,
+        max_in_flight=max_in_flight
+    )
+    print(stats.summary())
 
     return vectorstore
 
@@ -216,10 +300,10 @@ if __name__ == "__main__":
             print(f"内容: {doc['page_content']}")
 
         # ベクトルストアの保存
-        vectorstore.save("vectorstore_save.pkl")
+        vectorstore.save("vectorstore_save")
 
         # ベクトルストアの読み込み
-        loaded_vectorstore = SimpleVectorStore.load("vectorstore_save.pkl")
+        loaded_vectorstore = SimpleVectorStore.load("vectorstore_save", mmap=True)
 
     except Exception as e:
         print(f"エラーが発生しました: {e}")
@@ -2,20 +2,177 @@ from pathlib import Path
 import numpy as np
 import json
 import os
+import queue
 import sqlite3
-from typing import List, Dict, Tuple, Optional
+import threading
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import List, Dict, Set, Tuple, Optional, Union
 from openai import AzureOpenAI
-from tenacity import retry, stop_after_attempt, wait_exponential
+from embedding_cache import EmbeddingCache
+from embedder import AzureOpenAIEmbedder
+from ingestion import read_markdown_files, run_pipeline
+from vector_storage import normalize, top_k_indices
 
 class SQLiteVectorStore:
-    def __init__(self, db_path: str = "vectorstore.db"):
-        """SQLiteベースのベクトルストアを初期化"""
+    # vector_blocksテーブルに保存するベクトルの形式
+    VECTOR_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+    # int8のスケール。行は正規化済みで各成分は[-1, 1]に収まるため、全次元で固定の値を使う
+    INT8_SCALE = np.float32(1 / 127)
+    # 1つのBLOBにまとめるベクトルの行数
+    BLOCK_SIZE = 1024
+    # 末尾に追加したままにしておく端数のブロックの上限 (超えたら1つにまとめる)
+    MAX_PARTIAL_BLOCKS = 16
+    # 検索時のフィルタに使えるメタデータ項目 (documentsテーブルにインデックス付きの生成列として持つ)
+    FILTER_COLUMNS = {"source": "TEXT", "source_type": "TEXT", "is_table": "INTEGER", "added_at": "TEXT"}
+
+    def __init__(
+        self,
+        db_path: str = "vectorstore.db",
+        quantization: Optional[str] = None,
+        rerank_k: int = 100,
+        cache_vectors: bool = True,
+        full_text_search: bool = False,
+        n_readers: Optional[int] = None
+    ):
+        """
+        SQLiteベースのベクトルストアを初期化
+        ベクトルは正規化してBLOCK_SIZE行ずつ1つのBLOBにまとめ、vector_blocksテーブルに保存する
+        quantizationに "float16" / "int8" を指定すると、ブロックには量子化したベクトルを保存し、
+        全精度のベクトルは再スコアリング用に vectors_full テーブルへ保存する
+        形式はデータベース作成時に決まり、既存のデータベースを開く場合は省略できる
+        cache_vectors=False の場合はベクトルをメモリに常駐させず、検索のたびにブロックを順に読んで走査する
+        (メモリに載らない大きさのデータベース向け)
+        full_text_search=True の場合は hybrid_search 用の全文検索インデックスを作成する
+        (一度作成したデータベースでは、以降は指定しなくても追加・削除が同期される)
+
+        複数スレッドから同時に使える。書き込みは専用スレッドが1つの接続でキューから順に実行し、
+        検索はn_readers個 (省略時はCPUコア数) の読み込み専用接続で並行に実行する
+        """
+        if quantization is not None and quantization not in self.VECTOR_DTYPES:
+            raise ValueError(f"未対応の量子化形式です: {quantization}")
+
         self.db_path = db_path
+        self.rerank_k = rerank_k     # 量子化時に全精度で再スコアリングする候補数 (0で無効)
+        self.cache_vectors = cache_vectors
+        self._conn = self._connect()  # 書き込み用の接続 (書き込みスレッドだけが使う)
+        # ベクトルの常駐キャッシュ (最初の検索時に読み込み、追加・削除のたびに同期する)
+        # 検索中のスレッドが参照している配列は書き換えず、末尾への追加か新しい配列への置き換えだけを行う
+        self._cache_lock = threading.Lock()
+        self._cache_ids = None        # document_id (int64)
+        self._cache_vectors = None    # 保存形式のベクトル (float32は正規化済み)。倍々で事前確保する
+        self._cache_size = 0
+        self._cache_revision = None   # キャッシュに反映済みのリビジョン (store_configのrevision)
         self._init_db()
+        self.fts_enabled = self._init_fts(full_text_search)
+        self.quantization, self._int8_scale = self._init_quantization(quantization)
+        self._migrate_vector_rows()
+
+        # closeとの前後関係を決めるため、書き込みの投入と読み込み接続の返却はこのロックの中で行う
+        self._close_lock = threading.Lock()
+        self._closed = False
+        self._write_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self._readers = queue.Queue()
+        for _ in range(n_readers or os.cpu_count() or 1):
+            self._readers.put(self._connect(read_only=True))
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        """
+        ストアが使い続ける接続を開く (スレッド間で受け渡すため check_same_thread=False)
+        WALモードにして読み込みと書き込みが互いを待たないようにし、
+        コミットごとのfsyncはチェックポイント時だけに減らす (synchronous=NORMAL)
+        """
+        if read_only:
+            uri = Path(self.db_path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            conn.execute('PRAGMA cache_size=-65536')
+            return conn
+
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA cache_size=-65536')   # ページキャッシュ 64MiB
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _write_loop(self):
+        """書き込みスレッド: キューに積まれた書き込みを1つずつ実行し、結果をFutureに返す"""
+        while True:
+            task = self._write_queue.get()
+            if task is None:
+                break
+            future, func, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def _submit_write(self, func, *args):
+        """書き込みスレッドでfuncを実行し、完了まで待って結果を返す"""
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("ストアは既に閉じられています")
+            self._write_queue.put((future, func, args))
+        return future.result()
+
+    @contextmanager
+    def _reader(self):
+        """読み込み専用接続を1つ借りてカーソルを返す (すべて使用中なら空くまで待つ)"""
+        if self._closed:
+            raise RuntimeError("ストアは既に閉じられています")
+        conn = self._readers.get()
+        if conn is None:
+            # closeが待機中のスレッドを起こすために入れた印。次に待っているスレッドのために戻しておく
+            self._readers.put(None)
+            raise RuntimeError("ストアは既に閉じられています")
+        try:
+            yield conn.cursor()
+        finally:
+            with self._close_lock:
+                if self._closed:
+                    conn.close()
+                else:
+                    self._readers.put(conn)
+
+    def close(self):
+        """
+        書き込みスレッドを止め、データベースへの接続をすべて閉じる
+        検索中のスレッドが使っている接続は、返却されたときに閉じる
+        """
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+        # 閉じる前に投入された書き込みは、書き込みスレッドが実行し終えてから止まる
+        self._write_queue.put(None)
+        self._writer.join()
+        self._conn.close()
+        self._conn = None
+        while True:
+            try:
+                conn = self._readers.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                conn.close()
+        self._readers.put(None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def _init_db(self):
         """データベースとテーブルを初期化"""
-        with sqlite3.connect(self.db_path) as conn:
+        with self._conn as conn:
             cursor = conn.cursor()
             # documentsテーブル: テキストとメタデータを保存
             cursor.execute('''
@@ -26,7 +183,7 @@ class SQLiteVectorStore:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-            # vectorsテーブル: 埋め込みベクトルを保存
+            # vectorsテーブル: 1行1ベクトルの旧形式 (開いたときにvector_blocksへ移行する)
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS vectors (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -36,125 +193,896 @@ class SQLiteVectorStore:
                     FOREIGN KEY (document_id) REFERENCES documents (id)
                 )
             ''')
+            # vector_blocksテーブル: 正規化済みのベクトルをBLOCK_SIZE行ずつまとめて保存
+            # document_idsはint64、vectorsは保存形式の行列をそれぞれ1つのBLOBにしたもの
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vector_blocks (
+                    block_id INTEGER PRIMARY KEY,
+                    min_id INTEGER NOT NULL,
+                    max_id INTEGER NOT NULL,
+                    document_ids BLOB NOT NULL,
+                    vectors BLOB NOT NULL
+                )
+            ''')
+            # ブロックのid範囲は互いに重ならないため、max_idの索引で指定したidを含むブロックを引ける
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_vector_blocks_max_id ON vector_blocks (max_id)')
+            # vectors_fullテーブル: 量子化時の再スコアリング用に全精度 (float32) のベクトルを保存
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vectors_full (
+                    document_id INTEGER PRIMARY KEY,
+                    vector BLOB NOT NULL,
+                    FOREIGN KEY (document_id) REFERENCES documents (id)
+                )
+            ''')
+            # store_configテーブル: ベクトルの保存形式などの設定を保存
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS store_config (
+                    key TEXT PRIMARY KEY,
+                    value BLOB
+                )
+            ''')
+            # ingested_chunksテーブル: ドキュメントごとの取り込み元のチャンク (ファイル名, 内容と分割設定のsha256, チャンク番号)
+            # ドキュメントと同じトランザクションで記録・削除し、中断した取り込みの再開と古いチャンクの削除に使う
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ingested_chunks (
+                    document_id INTEGER PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    chunk_index INTEGER NOT NULL,
+                    FOREIGN KEY (document_id) REFERENCES documents (id)
+                )
+            ''')
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS idx_ingested_chunks_source ON ingested_chunks (source, digest)'
+            )
+            self._init_filter_columns(cursor)
             conn.commit()
 
-    def add_vectors(self, vectors: List[List[float]], texts: List[str], metadatas: Optional[List[Dict]] = None):
-        """ベクトル、テキスト、メタデータをデータベースに追加"""
+    def _init_filter_columns(self, cursor):
+        """
+        FILTER_COLUMNSの項目をメタデータのJSONから取り出す生成列 (VIRTUAL) をdocumentsテーブルに追加し、
+        インデックスを作成する (既存のデータベースにも後から追加できる)
+        """
+        cursor.execute('PRAGMA table_xinfo(documents)')
+        existing = {row[1] for row in cursor.fetchall()}
+        for name, column_type in self.FILTER_COLUMNS.items():
+            if name not in existing:
+                cursor.execute(
+                    f"ALTER TABLE documents ADD COLUMN {name} {column_type} "
+                    f"GENERATED ALWAYS AS (json_extract(metadata, '$.{name}')) VIRTUAL"
+                )
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_documents_{name} ON documents ({name})')
+
+    def _init_fts(self, create: bool) -> bool:
+        """
+        documents.text の全文検索インデックス (FTS5, trigramトークナイザ) を作成し、使えるかどうかを返す
+        trigramは分かち書きが不要で日本語の部分一致に使える。テキスト本体はdocumentsテーブルだけに持ち、
+        トリガーで追加・削除を同期する。FTS5/trigramが使えないSQLite (3.34未満など) ではFalseを返す
+        trigramのインデックス作成は追加のたびにテキスト長に比例してかかるため、createを指定した場合だけ作成する
+        """
+        with self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'documents_fts')")
+            exists = cursor.fetchone()[0]
+            if not (exists or create):
+                return False
+            try:
+                cursor.execute('''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                        text, content='documents', content_rowid='id', tokenize='trigram'
+                    )
+                ''')
+            except sqlite3.OperationalError:
+                return False
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS documents_fts_insert AFTER INSERT ON documents BEGIN
+                    INSERT INTO documents_fts (rowid, text) VALUES (new.id, new.text);
+                END
+            ''')
+            cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS documents_fts_delete AFTER DELETE ON documents BEGIN
+                    INSERT INTO documents_fts (documents_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                END
+            ''')
+            # インデックス作成前から登録されていたドキュメントを取り込む
+            if not exists:
+                cursor.execute("INSERT INTO documents_fts (documents_fts) VALUES ('rebuild')")
+        return True
+
+    def _init_quantization(self, requested: Optional[str]) -> Tuple[str, Optional[np.ndarray]]:
+        """保存済みの量子化形式を読み込む (新しいデータベースでは指定された形式を保存)"""
+        with self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT value FROM store_config WHERE key = 'quantization'")
+            row = cursor.fetchone()
+            if row:
+                quantization = row[0]
+            else:
+                # 設定がない既存のデータベースはfloat32で作成されたものとして扱う
+                cursor.execute('SELECT EXISTS (SELECT 1 FROM vectors)')
+                has_vectors = cursor.fetchone()[0]
+                quantization = "float32" if has_vectors else (requested or "float32")
+                cursor.execute(
+                    "INSERT INTO store_config (key, value) VALUES ('quantization', ?)",
+                    (quantization,)
+                )
+                conn.commit()
+
+            if requested is not None and requested != quantization:
+                raise ValueError(f"このデータベースは {quantization} 形式で作成されています")
+
+            # 次元ごとのスケールを保存している古いデータベースは、そのスケールで読み書きする
+            cursor.execute("SELECT value FROM store_config WHERE key = 'int8_scale'")
+            row = cursor.fetchone()
+            scale = np.frombuffer(row[0], dtype=np.float32) if row else self.INT8_SCALE
+        return quantization, scale
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        正規化済みベクトルを保存形式に変換
+        int8は固定のスケール (1/127) で丸めるため、後から追加したベクトルも切り詰められない
+        """
+        if self.quantization == "float16":
+            return vectors.astype(np.float16)
+        return np.clip(np.rint(vectors / self._int8_scale), -127, 127).astype(np.int8)
+
+    def _migrate_vector_rows(self):
+        """旧形式のvectorsテーブルに残っているベクトルをブロック形式に移す"""
+        with self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT EXISTS (SELECT 1 FROM vectors)')
+            if not cursor.fetchone()[0]:
+                return
+            cursor.execute('BEGIN IMMEDIATE')
+            document_ids, vectors = self._read_vectors(cursor, "vectors")
+            order = np.argsort(document_ids, kind='stable')
+            document_ids, vectors = document_ids[order], vectors[order]
+            # 旧形式のfloat32は正規化せずに保存されている
+            if self.quantization == "float32":
+                vectors = self._normalize(vectors)
+            self._write_blocks(cursor, document_ids, vectors)
+            cursor.execute('DELETE FROM vectors')
+
+    def add_vectors(
+        self,
+        vectors: Union[np.ndarray, List[List[float]]],
+        texts: List[str],
+        metadatas: Optional[List[Dict]] = None,
+        chunk_keys: Optional[List[Tuple[str, str, int]]] = None
+    ) -> List[int]:
+        """
+        ベクトル、テキスト、メタデータをデータベースに追加し、追加したドキュメントのidを返す
+        バッチ全体を1つのトランザクションで、テーブルごとに1回のexecutemanyで書き込む
+        vectorsがfloat32のndarrayの場合はコピーせずにそのまま使う
+        chunk_keys (ファイル名, 内容と分割設定のsha256, チャンク番号) を渡すと、同じトランザクションで取り込み済みとして記録する
+        """
         if not metadatas:
             metadatas = [{} for _ in texts]
+        if len(texts) == 0:
+            return []
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or not (len(vectors) == len(texts) == len(metadatas)):
+            raise ValueError("vectors, texts, metadatas の件数が一致しません")
+        # 正規化は呼び出し元のスレッドで済ませ、書き込みスレッドではSQLiteへの書き込みだけを行う
+        return self._submit_write(self._add_vectors, self._normalize(vectors), texts, metadatas, chunk_keys)
 
-        with sqlite3.connect(self.db_path) as conn:
+    def _add_vectors(
+        self,
+        vectors: np.ndarray,
+        texts: List[str],
+        metadatas: List[Dict],
+        chunk_keys: Optional[List[Tuple[str, str, int]]]
+    ) -> List[int]:
+        quantized = self.quantization != "float32"
+        with self._conn as conn:
             cursor = conn.cursor()
-            
-            for vector, text, metadata in zip(vectors, texts, metadatas):
-                # テキストとメタデータを追加
-                cursor.execute(
-                    'INSERT INTO documents (text, metadata) VALUES (?, ?)',
-                    (text, json.dumps(metadata))
+            # 他の書き込みと競合しないよう先に書き込みロックを取り、連番のidをまとめて割り当てる
+            # (AUTOINCREMENTの採番位置はsqlite_sequenceに記録されている)
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'documents'")
+            row = cursor.fetchone()
+            first_id = (row[0] if row else 0) + 1
+            document_ids = list(range(first_id, first_id + len(texts)))
+
+            # 量子化する場合は全精度のベクトルも別テーブルに残す
+            stored_vectors = self._quantize(vectors) if quantized else vectors
+
+            cursor.executemany(
+                'INSERT INTO documents (id, text, metadata) VALUES (?, ?, ?)',
+                zip(document_ids, texts, map(json.dumps, metadatas))
+            )
+            self._write_blocks(cursor, np.array(document_ids, dtype=np.int64), stored_vectors)
+            if quantized:
+                # バッチ全体を1回でバイト列に変換し、行ごとのBLOBはコピーせずに切り出す
+                cursor.executemany(
+                    'INSERT INTO vectors_full (document_id, vector) VALUES (?, ?)',
+                    zip(document_ids, self._split_rows(vectors))
+                )
+            if chunk_keys:
+                cursor.executemany(
+                    'INSERT INTO ingested_chunks (document_id, source, digest, chunk_index) VALUES (?, ?, ?, ?)',
+                    ((document_id, *key) for document_id, key in zip(document_ids, chunk_keys))
                 )
-                document_id = cursor.lastrowid
+            revision = self._bump_revision(cursor)
+        self._append_cache(document_ids, stored_vectors, revision)
+        return document_ids
 
-                # ベクトルをバイナリに変換して保存
-                vector_array = np.array(vector, dtype=np.float32)
-                cursor.execute(
-                    'INSERT INTO vectors (document_id, vector, dimension) VALUES (?, ?, ?)',
-                    (document_id, vector_array.tobytes(), len(vector))
+    def ingested_chunks(self, source: str, digest: str) -> Set[int]:
+        """指定したファイル (内容と分割設定のsha256) の取り込み済みチャンク番号の集合を返す"""
+        with self._reader() as cursor:
+            cursor.execute(
+                'SELECT chunk_index FROM ingested_chunks WHERE source = ? AND digest = ?',
+                (source, digest)
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def delete_stale_chunks(self, digests: Dict[str, Set[str]]) -> int:
+        """
+        digests {ファイル名: 今回取り込んだsha256の集合} に含まれるファイルについて、
+        それ以外のsha256 (変更前の内容や分割設定) で取り込んだドキュメントを削除し、削除した数を返す
+        (空の集合を渡したファイルは、取り込んだドキュメントをすべて削除する)
+        """
+        if not digests:
+            return 0
+        return self._submit_write(self._delete_stale_chunks, digests)
+
+    def _delete_stale_chunks(self, digests: Dict[str, Set[str]]) -> int:
+        # 書き込みスレッドで実行するため、読んでから削除するまでの間に他の書き込みは入らない
+        cursor = self._conn.cursor()
+        params = []
+        for source, current in digests.items():
+            cursor.execute('SELECT document_id, digest FROM ingested_chunks WHERE source = ?', (source,))
+            params.extend((document_id,) for document_id, digest in cursor.fetchall() if digest not in current)
+        return self._delete(params) if params else 0
+
+    def delete(self, document_ids: List[int]) -> int:
+        """
+        指定したidのドキュメントとベクトルを削除し、削除したドキュメント数を返す
+        取り込み済みの記録も削除するため、次回の取り込みで削除したチャンクだけが取り込み直される
+        """
+        params = [(int(document_id),) for document_id in document_ids]
+        if not params:
+            return 0
+        return self._submit_write(self._delete, params)
+
+    def _delete(self, params: List[Tuple[int]]) -> int:
+        ids = np.array([p[0] for p in params], dtype=np.int64)
+        with self._conn as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            self._delete_from_blocks(cursor, ids)
+            cursor.executemany('DELETE FROM vectors_full WHERE document_id = ?', params)
+            cursor.executemany('DELETE FROM ingested_chunks WHERE document_id = ?', params)
+            cursor.executemany('DELETE FROM documents WHERE id = ?', params)
+            deleted = cursor.rowcount
+            revision = self._bump_revision(cursor)
+
+        with self._cache_lock:
+            if self._cache_ids is not None and self._cache_revision == revision - 1:
+                keep = np.flatnonzero(~np.isin(self._cache_ids[:self._cache_size], ids))
+                self._cache_ids = self._cache_ids[keep]
+                self._cache_vectors = self._cache_vectors[keep]
+                self._cache_size = len(keep)
+                self._cache_revision = revision
+            elif self._cache_revision is None or self._cache_revision < revision:
+                self._cache_ids = None
+        return deleted
+
+    @staticmethod
+    def _bump_revision(cursor) -> int:
+        """書き込みのたびにstore_configのrevisionを1増やし、新しい値を返す (キャッシュの鮮度の判定に使う)"""
+        cursor.execute(
+            "INSERT INTO store_config (key, value) VALUES ('revision', 1) "
+            "ON CONFLICT (key) DO UPDATE SET value = value + 1"
+        )
+        cursor.execute("SELECT value FROM store_config WHERE key = 'revision'")
+        return cursor.fetchone()[0]
+
+    def _write_blocks(self, cursor, document_ids: np.ndarray, stored_vectors: np.ndarray):
+        """
+        document_idの昇順に追加するベクトルをBLOCK_SIZE行ずつのBLOBにして末尾に追加する
+        端数のブロックも既存のブロックを書き直さずにそのまま追加し、末尾の端数のブロックが
+        合わせて1ブロック分以上になるか、MAX_PARTIAL_BLOCKS個に達したときだけまとめて詰め直す
+        """
+        cursor.execute(
+            'SELECT block_id, length(document_ids) / 8 FROM vector_blocks ORDER BY block_id DESC LIMIT ?',
+            (self.MAX_PARTIAL_BLOCKS + 1,)
+        )
+        partial = []
+        for block_id, n_rows in cursor.fetchall():
+            if n_rows >= self.BLOCK_SIZE:
+                break
+            partial.append((block_id, n_rows))
+
+        n_partial_rows = sum(n_rows for _, n_rows in partial)
+        if partial and (
+            n_partial_rows + len(document_ids) >= self.BLOCK_SIZE or len(partial) >= self.MAX_PARTIAL_BLOCKS
+        ):
+            first_block_id = partial[-1][0]
+            cursor.execute(
+                'SELECT document_ids, vectors FROM vector_blocks WHERE block_id >= ? ORDER BY block_id',
+                (first_block_id,)
+            )
+            blocks = [self._decode_block(ids_blob, vectors_blob) for ids_blob, vectors_blob in cursor.fetchall()]
+            cursor.execute('DELETE FROM vector_blocks WHERE block_id >= ?', (first_block_id,))
+            document_ids = np.concatenate([ids for ids, _ in blocks] + [document_ids])
+            stored_vectors = np.concatenate([vectors for _, vectors in blocks] + [stored_vectors])
+
+        cursor.executemany(
+            'INSERT INTO vector_blocks (min_id, max_id, document_ids, vectors) VALUES (?, ?, ?, ?)',
+            (
+                (
+                    int(document_ids[start]),
+                    int(document_ids[min(start + self.BLOCK_SIZE, len(document_ids)) - 1]),
+                    document_ids[start:start + self.BLOCK_SIZE].tobytes(),
+                    np.ascontiguousarray(stored_vectors[start:start + self.BLOCK_SIZE]).tobytes()
                 )
-            
-            conn.commit()
+                for start in range(0, len(document_ids), self.BLOCK_SIZE)
+            )
+        )
 
-    def similarity_search(self, query_vector: List[float], k: int = 5) -> List[Tuple[Dict, float]]:
+    def _blocks_containing(self, cursor, document_ids: np.ndarray):
+        """
+        昇順のdocument_idsのいずれかを含むブロックを (block_id, document_id配列, 保存形式の行列) として1つずつ返す
+        未処理の最小のidからmax_idの索引で次のブロックを引き、そのブロックの範囲に入るidをまとめて進める
+        (指定したidを含まないブロックのBLOBは読まない)
+        """
+        position = 0
+        while position < len(document_ids):
+            cursor.execute(
+                'SELECT block_id, min_id, max_id FROM vector_blocks WHERE max_id >= ? ORDER BY max_id LIMIT 1',
+                (int(document_ids[position]),)
+            )
+            row = cursor.fetchone()
+            if row is None:
+                return
+            block_id, min_id, max_id = row
+            end = int(np.searchsorted(document_ids, max_id, side='right'))
+            if document_ids[end - 1] >= min_id:
+                cursor.execute('SELECT document_ids, vectors FROM vector_blocks WHERE block_id = ?', (block_id,))
+                yield (block_id, *self._decode_block(*cursor.fetchone()))
+            position = end
+
+    def _delete_from_blocks(self, cursor, document_ids: np.ndarray):
+        """削除するidを含むブロックだけを1つずつ読み、残りの行で書き直す (空になったブロックは削除)"""
+        document_ids = np.unique(document_ids)
+        for block_id, ids, vectors in self._blocks_containing(cursor, document_ids):
+            keep = ~np.isin(ids, document_ids, assume_unique=True)
+            if keep.all():
+                continue
+            if not keep.any():
+                cursor.execute('DELETE FROM vector_blocks WHERE block_id = ?', (block_id,))
+                continue
+            ids, vectors = ids[keep], vectors[keep]
+            cursor.execute(
+                'UPDATE vector_blocks SET min_id = ?, max_id = ?, document_ids = ?, vectors = ? WHERE block_id = ?',
+                (int(ids[0]), int(ids[-1]), ids.tobytes(), np.ascontiguousarray(vectors).tobytes(), block_id)
+            )
+
+    def _decode_block(self, ids_blob: bytes, vectors_blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+        """ブロックのBLOBを (document_id配列, 保存形式の行列) に変換 (コピーせずにバッファを参照する)"""
+        document_ids = np.frombuffer(ids_blob, dtype=np.int64)
+        vectors = np.frombuffer(vectors_blob, dtype=self.VECTOR_DTYPES[self.quantization])
+        return document_ids, vectors.reshape(len(document_ids), -1)
+
+    @staticmethod
+    def _split_rows(matrix: np.ndarray):
+        """行列を1回でバイト列に変換し、行ごとのmemoryviewを返す"""
+        data = memoryview(np.ascontiguousarray(matrix).tobytes())
+        row_size = matrix.shape[1] * matrix.itemsize
+        return (data[start:start + row_size] for start in range(0, len(data), row_size))
+
+    def similarity_search(
+        self,
+        query_vector: List[float],
+        k: int = 5,
+        filter: Optional[Dict[str, Union[str, int, bool, List, Tuple]]] = None
+    ) -> List[Tuple[Dict, float]]:
         """
         コサイン類似度に基づく検索を実行
-        注意: このメソッドはメモリ内で類似度計算を行うため、大規模なデータセットには適していません
+        ベクトルはメモリ上のキャッシュに対して1回の行列ベクトル積で比較し、
+        テキストとメタデータは上位k件だけをデータベースから取得する
+        filterを指定した場合は、条件に一致するidをSQLのインデックスで絞り込んでから採点する
         """
-        query_vector = np.array(query_vector, dtype=np.float32)
-        query_norm = np.linalg.norm(query_vector)
-        
-        results = []
-        with sqlite3.connect(self.db_path) as conn:
-            cursor = conn.cursor()
-            
-            # 全ベクトルを取得
-            cursor.execute('''
-                SELECT d.text, d.metadata, v.vector
-                FROM vectors v
-                JOIN documents d ON v.document_id = d.id
-            ''')
-            
-            for text, metadata_str, vector_bytes in cursor.fetchall():
-                vector = np.frombuffer(vector_bytes, dtype=np.float32)
-                
-                # コサイン類似度を計算
-                similarity = np.dot(vector, query_vector) / (np.linalg.norm(vector) * query_norm)
-                
-                doc = {
+        return self.similarity_search_batch([query_vector], k, filter=filter)[0]
+
+    def _filter_clause(self, filter: Dict) -> Tuple[str, List]:
+        """
+        filterをdocumentsテーブルの生成列に対するWHERE句とパラメータに変換
+        値はそのまま一致、リストはいずれかに一致、(下限, 上限) のタプルは範囲 (Noneは上限・下限なし)
+        """
+        clauses = []
+        params = []
+        for name, value in filter.items():
+            if name not in self.FILTER_COLUMNS:
+                raise ValueError(f"フィルタに使えない項目です: {name}")
+            if isinstance(value, tuple):
+                low, high = value
+                if low is not None:
+                    clauses.append(f'documents.{name} >= ?')
+                    params.append(low)
+                if high is not None:
+                    clauses.append(f'documents.{name} <= ?')
+                    params.append(high)
+            elif isinstance(value, list):
+                clauses.append(f'documents.{name} IN ({",".join("?" * len(value))})')
+                params.extend(value)
+            else:
+                clauses.append(f'documents.{name} = ?')
+                params.append(value)
+        return " AND ".join(clauses) or "1", params
+
+    def _filter_ids(self, cursor, filter: Optional[Dict]) -> Optional[np.ndarray]:
+        """フィルタ条件に一致するdocument_idを昇順で返す (フィルタなしの場合はNone)"""
+        if not filter:
+            return None
+        where, params = self._filter_clause(filter)
+        cursor.execute(f'SELECT id FROM documents WHERE {where} ORDER BY id', params)
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    _normalize = staticmethod(normalize)
+    _top_k_indices = staticmethod(top_k_indices)
+
+    @staticmethod
+    def _fetch_documents(cursor, document_ids: List[int]) -> Dict[int, Dict]:
+        """指定したidのテキストとメタデータだけを取得"""
+        documents = {}
+        # SQLiteのパラメータ数上限を超えないよう分割して取得
+        for start in range(0, len(document_ids), 500):
+            ids = document_ids[start:start + 500]
+            cursor.execute(
+                f'SELECT id, text, metadata FROM documents WHERE id IN ({",".join("?" * len(ids))})',
+                ids
+            )
+            for document_id, text, metadata_str in cursor.fetchall():
+                documents[document_id] = {
                     "page_content": text,
                     "metadata": json.loads(metadata_str)
                 }
-                results.append((doc, float(similarity)))
-        
-        # スコアで降順ソートし、上位k件を返す
-        results.sort(key=lambda x: x[1], reverse=True)
-        return results[:k]
+        return documents
+
+    @staticmethod
+    def _fetch_full_vectors(cursor, document_ids: List[int]) -> np.ndarray:
+        """指定したidの全精度ベクトルを、document_idsと同じ順序の行列として取得"""
+        vectors = {}
+        for start in range(0, len(document_ids), 500):
+            ids = document_ids[start:start + 500]
+            cursor.execute(
+                f'SELECT document_id, vector FROM vectors_full WHERE document_id IN ({",".join("?" * len(ids))})',
+                ids
+            )
+            vectors.update(cursor.fetchall())
+        # 検索中に削除されたidはゼロベクトル (類似度0) として扱う
+        missing = bytes(len(next(iter(vectors.values())))) if vectors else b""
+        return np.frombuffer(
+            b"".join(vectors.get(document_id, missing) for document_id in document_ids), dtype=np.float32
+        ).reshape(len(document_ids), -1)
+
+    def _read_vectors(self, cursor, table: str = "vectors_full") -> Tuple[np.ndarray, np.ndarray]:
+        """1行1ベクトルのテーブル (vectors_full / 旧形式のvectors) を (document_id配列, 行列) として読み込む"""
+        cursor.execute(f'SELECT document_id, vector FROM {table}')
+        rows = cursor.fetchall()
+        dtype = np.float32 if table == "vectors_full" else self.VECTOR_DTYPES[self.quantization]
+        document_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=dtype)
+        return document_ids, vectors.reshape(len(rows), -1 if rows else 0)
+
+    @staticmethod
+    def _read_revision(cursor) -> int:
+        cursor.execute("SELECT value FROM store_config WHERE key = 'revision'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _load_cache(self, cursor):
+        """全ブロックを読み込んで常駐キャッシュを作り直す (_cache_lockを取得済みで呼ぶ)"""
+        # 読み込み中に書き込まれても取りこぼさないよう、リビジョンとブロックを同じスナップショットから読む
+        cursor.execute('BEGIN')
+        try:
+            revision = self._read_revision(cursor)
+            cursor.execute('SELECT document_ids, vectors FROM vector_blocks ORDER BY block_id')
+            blocks = [self._decode_block(ids_blob, vectors_blob) for ids_blob, vectors_blob in cursor.fetchall()]
+            # 別のプロセスが古い形式のスケールを削除した場合に備えて読み直す
+            cursor.execute("SELECT value FROM store_config WHERE key = 'int8_scale'")
+            row = cursor.fetchone()
+        finally:
+            cursor.connection.rollback()
+        self._int8_scale = np.frombuffer(row[0], dtype=np.float32) if row else self.INT8_SCALE
+        if blocks:
+            self._cache_ids = np.concatenate([ids for ids, _ in blocks])
+            self._cache_vectors = np.concatenate([vectors for _, vectors in blocks])
+        else:
+            self._cache_ids = np.empty(0, dtype=np.int64)
+            self._cache_vectors = np.empty((0, 0), dtype=self.VECTOR_DTYPES[self.quantization])
+        self._cache_size = len(self._cache_ids)
+        self._cache_revision = revision
+
+    def _cached_vectors(self, cursor) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        常駐キャッシュの (document_id配列, 保存形式の行列) を返す
+        データベースのリビジョンがキャッシュより新しい (別プロセスなどが書き込んだ) 場合は読み直す
+        """
+        revision = self._read_revision(cursor)
+        with self._cache_lock:
+            if self._cache_ids is None or self._cache_revision < revision:
+                self._load_cache(cursor)
+            return self._cache_ids[:self._cache_size], self._cache_vectors[:self._cache_size]
+
+    def _append_cache(self, document_ids: List[int], stored_vectors: np.ndarray, revision: int):
+        """
+        追加した行を常駐キャッシュの末尾に書き込む (容量が足りなければ倍々で拡張)
+        キャッシュが直前のリビジョンでなければ、次の検索時に読み直すよう破棄する
+        """
+        with self._cache_lock:
+            if self._cache_ids is None or self._cache_revision >= revision:
+                return
+            if self._cache_revision != revision - 1:
+                self._cache_ids = None
+                return
+            self._append_cache_rows(document_ids, stored_vectors)
+            self._cache_revision = revision
+
+    def _append_cache_rows(self, document_ids: List[int], stored_vectors: np.ndarray):
+        required = self._cache_size + len(document_ids)
+        # 空のデータベースから読み込んだキャッシュは次元が0なので、最初の追加時に確保し直す
+        if required > len(self._cache_ids) or self._cache_vectors.shape[1] != stored_vectors.shape[1]:
+            capacity = max(required, 2 * len(self._cache_ids), 1024)
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:self._cache_size] = self._cache_ids[:self._cache_size]
+            vectors = np.empty((capacity, stored_vectors.shape[1]), dtype=stored_vectors.dtype)
+            if self._cache_size:
+                vectors[:self._cache_size] = self._cache_vectors[:self._cache_size]
+            self._cache_ids, self._cache_vectors = ids, vectors
+
+        self._cache_ids[self._cache_size:required] = document_ids
+        self._cache_vectors[self._cache_size:required] = stored_vectors
+        self._cache_size = required
+
+    def _score(self, vectors: np.ndarray, queries: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """
+        正規化済みクエリとキャッシュ上のベクトルの類似度を計算
+        キャッシュのベクトルは正規化済みなので内積をそのまま使い、int8ではスケールをクエリ側に掛けておく
+        """
+        if self.quantization == "float32":
+            return queries @ vectors.T
+        if self.quantization == "int8":
+            queries = queries * self._int8_scale
+        scores = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+        return scores
+
+    @staticmethod
+    def _cache_rows(cache_ids: np.ndarray, document_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """キャッシュ (id昇順) 上の行番号と、キャッシュに存在するかどうかを返す"""
+        if len(cache_ids) == 0:
+            return np.zeros(len(document_ids), dtype=np.intp), np.zeros(len(document_ids), dtype=bool)
+        rows = np.minimum(np.searchsorted(cache_ids, document_ids), len(cache_ids) - 1)
+        return rows, cache_ids[rows] == document_ids
+
+    def _top_candidates(
+        self,
+        document_ids: np.ndarray,
+        vectors: np.ndarray,
+        queries: np.ndarray,
+        n: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """クエリごとに類似度の高い上位n件の (document_id, 類似度) を返す"""
+        if len(document_ids) == 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        similarities = self._score(vectors, queries)
+        top_indices = self._top_k_indices(similarities, n)
+        return document_ids[top_indices], np.take_along_axis(similarities, top_indices, axis=1)
+
+    def _stream_top_candidates(
+        self,
+        cursor,
+        queries: np.ndarray,
+        n: int,
+        document_ids: Optional[np.ndarray] = None,
+        fetch_size: int = 16
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        ブロックをfetch_size件ずつ順に読み、ブロックごとに1回の行列積で類似度を計算する
+        各ブロックの上位n件をそれまでの上位n件と合わせて選び直すことで、メモリ上にはn件分だけを保持する
+        document_ids (昇順) を指定した場合は、そのidを含みうるブロックの該当行だけを採点する
+        """
+        top_ids = np.empty((len(queries), 0), dtype=np.int64)
+        top_scores = np.empty((len(queries), 0), dtype=np.float32)
+        if document_ids is None:
+            cursor.execute('SELECT document_ids, vectors FROM vector_blocks')
+        elif len(document_ids) == 0:
+            return top_ids, top_scores
+        else:
+            cursor.execute(
+                'SELECT document_ids, vectors FROM vector_blocks WHERE max_id >= ? AND min_id <= ?',
+                (int(document_ids[0]), int(document_ids[-1]))
+            )
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for ids_blob, vectors_blob in rows:
+                ids, vectors = self._decode_block(ids_blob, vectors_blob)
+                if document_ids is not None:
+                    rows_in_filter = np.flatnonzero(np.isin(ids, document_ids, assume_unique=True))
+                    ids, vectors = ids[rows_in_filter], vectors[rows_in_filter]
+                block_ids, block_scores = self._top_candidates(ids, vectors, queries, n)
+                merged_ids = np.concatenate([top_ids, block_ids], axis=1)
+                merged_scores = np.concatenate([top_scores, block_scores], axis=1)
+                top_indices = self._top_k_indices(merged_scores, n)
+                top_ids = np.take_along_axis(merged_ids, top_indices, axis=1)
+                top_scores = np.take_along_axis(merged_scores, top_indices, axis=1)
+        return top_ids, top_scores
+
+    def _search_ids(
+        self,
+        cursor,
+        queries: np.ndarray,
+        k: int,
+        rerank_k: int,
+        document_ids: Optional[np.ndarray] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        正規化済みクエリごとの上位k件の (document_id, 類似度) を返す
+        cache_vectors=True ならキャッシュ上で、Falseならブロックを順に読みながら走査する
+        document_ids (昇順) を指定した場合は、そのidのベクトルだけを採点する
+        量子化時は上位rerank_k件を全精度のベクトルで再スコアリングする
+        """
+        rerank = self.quantization != "float32" and rerank_k
+        n = max(k, rerank_k) if rerank else k
+        if self.cache_vectors:
+            cache_ids, vectors = self._cached_vectors(cursor)
+            if document_ids is not None:
+                rows, found = self._cache_rows(cache_ids, document_ids)
+                rows = rows[found]
+                cache_ids, vectors = cache_ids[rows], vectors[rows]
+            candidate_ids, scores = self._top_candidates(cache_ids, vectors, queries, n)
+        else:
+            candidate_ids, scores = self._stream_top_candidates(cursor, queries, n, document_ids)
+        if not rerank or candidate_ids.shape[1] == 0:
+            return candidate_ids, scores
+
+        unique_ids, inverse = np.unique(candidate_ids, return_inverse=True)
+        full_vectors = self._fetch_full_vectors(cursor, unique_ids.tolist())
+        exact = np.einsum('mcd,md->mc', full_vectors[inverse.reshape(candidate_ids.shape)], queries)
+        top_k_indices = self._top_k_indices(exact, k)
+        return (
+            np.take_along_axis(candidate_ids, top_k_indices, axis=1),
+            np.take_along_axis(exact, top_k_indices, axis=1)
+        )
+
+    def similarity_search_batch(
+        self,
+        query_matrix: List[List[float]],
+        k: int = 5,
+        block_size: int = 256,
+        filter: Optional[Dict[str, Union[str, int, bool, List, Tuple]]] = None
+    ) -> List[List[Tuple[Dict, float]]]:
+        """
+        複数クエリをまとめて検索し、クエリごとに similarity_search と同じ形式の結果を返す
+        ベクトルに対してblock_size件ずつ1回の行列積で類似度を計算する
+        テキストとメタデータは上位k件に入ったドキュメントのみ取得する
+        """
+        query_matrix = np.atleast_2d(np.asarray(query_matrix, dtype=np.float32))
+
+        with self._reader() as cursor:
+            # 他の接続の書き込みでキャッシュを読み直す場合に備え、絞り込みより先にキャッシュを確定させる
+            if self.cache_vectors:
+                self._cached_vectors(cursor)
+            document_ids = self._filter_ids(cursor, filter)
+            top_k_ids = []
+            top_k_scores = []
+            for start in range(0, len(query_matrix), block_size):
+                queries = self._normalize(query_matrix[start:start + block_size])
+                ids, scores = self._search_ids(cursor, queries, k, self.rerank_k, document_ids)
+                top_k_ids.append(ids)
+                top_k_scores.append(scores)
+            top_k_ids = np.concatenate(top_k_ids)
+            top_k_scores = np.concatenate(top_k_scores)
+
+            documents = self._fetch_documents(cursor, np.unique(top_k_ids).tolist())
+
+        # 検索中に削除されたドキュメントは結果から除く
+        return [
+            [
+                (documents[document_id], float(score))
+                for document_id, score in zip(ids, scores)
+                if document_id in documents
+            ]
+            for ids, scores in zip(top_k_ids.tolist(), top_k_scores)
+        ]
+
+    @staticmethod
+    def _fts_query(query_text: str) -> Optional[str]:
+        """
+        検索文を空白で区切り、各語をフレーズとしてORで結んだFTS5の検索式にする
+        trigramは3文字未満の語に一致しないため、そのような語は除く (使える語がなければNone)
+        """
+        terms = [term for term in query_text.split() if len(term) >= 3]
+        if not terms:
+            return None
+        return " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    def _lexical_ids(self, cursor, query_text: str, limit: int, filter: Optional[Dict] = None) -> np.ndarray:
+        """BM25の順位で上位limit件のdocument_idを返す (filterの条件も同じSQLで適用する)"""
+        fts_query = self._fts_query(query_text)
+        if fts_query is None:
+            return np.empty(0, dtype=np.int64)
+        where, params = self._filter_clause(filter or {})
+        cursor.execute(
+            'SELECT documents_fts.rowid FROM documents_fts '
+            'JOIN documents ON documents.id = documents_fts.rowid '
+            f'WHERE documents_fts MATCH ? AND {where} '
+            'ORDER BY bm25(documents_fts) LIMIT ?',
+            [fts_query, *params, limit]
+        )
+        return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+
+    def _candidate_vectors(self, cursor, document_ids: np.ndarray) -> np.ndarray:
+        """指定したidの正規化済みベクトルを、document_idsと同じ順序のfloat32行列として取得"""
+        if self.quantization != "float32":
+            return self._fetch_full_vectors(cursor, document_ids.tolist())
+        if self.cache_vectors:
+            cache_ids, vectors = self._cached_vectors(cursor)
+            rows, found = self._cache_rows(cache_ids, document_ids)
+            # 検索中に削除された候補は類似度0として扱う
+            return np.where(found[:, None], vectors[rows], 0).astype(np.float32)
+
+        # キャッシュがない場合は、候補を含むブロックだけを1つずつ読み、候補の行だけを取り出す
+        # (検索中に削除された候補は類似度0として扱う)
+        wanted = np.unique(document_ids)
+        vectors = None
+        for _, block_ids, block_vectors in self._blocks_containing(cursor, wanted):
+            rows, found = self._cache_rows(block_ids, wanted)
+            if vectors is None:
+                vectors = np.zeros((len(wanted), block_vectors.shape[1]), dtype=np.float32)
+            vectors[found] = block_vectors[rows[found]]
+        if vectors is None:
+            return np.zeros((len(document_ids), 0), dtype=np.float32)
+        return vectors[np.searchsorted(wanted, document_ids)]
+
+    def hybrid_search(
+        self,
+        query_text: str,
+        query_vector: List[float],
+        k: int = 5,
+        lexical_k: int = 100,
+        vector_k: int = 0,
+        rrf_k: int = 60,
+        filter: Optional[Dict[str, Union[str, int, bool, List, Tuple]]] = None
+    ) -> List[Tuple[Dict, float]]:
+        """
+        全文検索 (BM25) とコサイン類似度の順位を Reciprocal Rank Fusion で統合して検索
+        BM25の上位lexical_k件だけをベクトルで再スコアリングし、両方の順位から 1 / (rrf_k + 順位) の和で並べる
+        vector_k > 0 の場合は、ベクトル検索の上位vector_k件も候補に加える
+        全文検索で候補が見つからない場合はベクトル検索の結果を返す
+        filterは similarity_search と同じで、全文検索・ベクトル検索の両方に適用する
+        スコアはRRFのスコア (コサイン類似度ではない)
+        """
+        if not self.fts_enabled:
+            raise RuntimeError(
+                "全文検索インデックスがありません (full_text_search=True で作成、FTS5のtrigramに対応したSQLiteが必要)"
+            )
+
+        query = self._normalize(np.asarray(query_vector, dtype=np.float32))
+        with self._reader() as cursor:
+            lexical_ids = self._lexical_ids(cursor, query_text, lexical_k, filter)
+        if len(lexical_ids) == 0 and not vector_k:
+            return self.similarity_search(query_vector, k, filter=filter)
+
+        with self._reader() as cursor:
+            candidate_ids = lexical_ids
+            if vector_k:
+                dense_ids, _ = self._search_ids(
+                    cursor, query[None, :], vector_k, self.rerank_k, self._filter_ids(cursor, filter)
+                )
+                candidate_ids = np.union1d(lexical_ids, dense_ids[0])
+            if len(candidate_ids) == 0:
+                return []
+
+            # 候補だけをベクトルで採点して、コサイン類似度の順位を付ける
+            similarities = self._candidate_vectors(cursor, candidate_ids) @ query
+            dense_order = candidate_ids[np.argsort(-similarities, kind='stable')]
+
+            fused = {}
+            for ranking in (lexical_ids, dense_order):
+                for rank, document_id in enumerate(ranking.tolist(), 1):
+                    fused[document_id] = fused.get(document_id, 0.0) + 1.0 / (rrf_k + rank)
+            top_ids = sorted(fused, key=fused.get, reverse=True)[:k]
+            documents = self._fetch_documents(cursor, top_ids)
+
+        return [(documents[document_id], fused[document_id]) for document_id in top_ids if document_id in documents]
+
+    def evaluate_recall(
+        self,
+        query_matrix: List[List[float]],
+        k: int = 10,
+        rerank_k: Optional[int] = None
+    ) -> float:
+        """
+        量子化ベクトルでの検索結果の上位k件が、全精度での上位k件をどれだけ含むか (recall@k) を返す
+        rerank_k=0 を指定すると再スコアリングなしの精度を測定できる
+        """
+        if self.quantization == "float32":
+            return 1.0
+
+        queries = self._normalize(np.atleast_2d(np.asarray(query_matrix, dtype=np.float32)))
+        rerank_k = self.rerank_k if rerank_k is None else rerank_k
+        with self._reader() as cursor:
+            approx_ids, _ = self._search_ids(cursor, queries, k, rerank_k)
+            if approx_ids.size == 0:
+                return 0.0
+
+            full_ids, full_vectors = self._read_vectors(cursor, "vectors_full")
+            exact_ids = full_ids[self._top_k_indices(queries @ full_vectors.T, k)]
+
+        hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx_ids, exact_ids))
+        return hits / exact_ids.size
 
     def clear(self):
-        """データベースの内容をクリア"""
-        with sqlite3.connect(self.db_path) as conn:
+        """データベースの内容をクリア (量子化形式の設定は保持し、古い形式のint8のスケールは固定のスケールに戻す)"""
+        self._submit_write(self._clear)
+
+    def _clear(self):
+        with self._conn as conn:
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM vectors')
+            cursor.execute('DELETE FROM vector_blocks')
+            cursor.execute('DELETE FROM vectors_full')
             cursor.execute('DELETE FROM documents')
-            conn.commit()
+            cursor.execute('DELETE FROM ingested_chunks')
+            cursor.execute("DELETE FROM store_config WHERE key = 'int8_scale'")
+            self._bump_revision(cursor)
+        self._int8_scale = self.INT8_SCALE
+        with self._cache_lock:
+            self._cache_ids = None
 
-class AzureOpenAIEmbedder:
-    """Azure OpenAIを使用して埋め込みを生成するクラス"""
-    def __init__(self, client=None, model=None, timeout=60):
-        self.client = client or AzureOpenAI(
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION", "2024-02-15-preview")
-        )
-        self.model = model or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
-        self.timeout = timeout
 
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        reraise=True
-    )
-    def embed_documents(self, texts):
-        """テキストの配列を埋め込みベクトルに変換"""
-        try:
-            response = self.client.embeddings.create(
-                model=self.model,
-                input=texts,
-                timeout=self.timeout
-            )
-            return [embedding.embedding for embedding in response.data]
-        except Exception as e:
-            print(f"埋め込み生成中にエラーが発生: {e}")
-            raise
-
-    def embed_query(self, text):
-        """単一のクエリテキストを埋め込みベクトルに変換"""
-        return self.embed_documents([text])[0]
-
-def read_markdown_files(directory_path):
-    """指定されたディレクトリから全てのマークダウンファイルを読み込む"""
-    markdown_files = []
-    directory = Path(directory_path)
-    
-    for extension in ['*.md', '*.markdown']:
-        for file_path in directory.rglob(extension):
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                    relative_path = str(file_path.relative_to(directory))
-                    markdown_files.append((relative_path, content))
-            except Exception as e:
-                print(f"警告: ファイル {file_path} の読み込み中にエラーが発生しました: {e}")
-    
-    return markdown_files
+class AsyncSQLiteVectorStore:
+    """
+    asyncioのサーバーからSQLiteVectorStoreを使うためのラッパー
+    検索・書き込みをスレッドプールで実行し、イベントループを止めないようにする
+    """
+    def __init__(self, store: SQLiteVectorStore, max_workers: Optional[int] = None):
+        self.store = store
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def similarity_search(self, query_vector: np.ndarray, k: int = 5, filter: Optional[Dict] = None):
+        return await self._run(self.store.similarity_search, query_vector, k, filter=filter)
+
+    async def similarity_search_batch(self, query_matrix: np.ndarray, k: int = 5, filter: Optional[Dict] = None):
+        return await self._run(self.store.similarity_search_batch, query_matrix, k, filter=filter)
+
+    async def hybrid_search(self, query_text: str, query_vector: np.ndarray, k: int = 5, **kwargs):
+        return await self._run(self.store.hybrid_search, query_text, query_vector, k, **kwargs)
+
+    async def add_vectors(
+        self,
+        vectors: np.ndarray,
+        texts: List[str],
+        metadatas: Optional[List[Dict]] = None,
+        chunk_keys: Optional[List[Tuple[str, str, int]]] = None,
+        **kwargs
+    ) -> List[int]:
+        return await self._run(self.store.add_vectors, vectors, texts, metadatas, chunk_keys=chunk_keys, **kwargs)
+
+    async def delete(self, document_ids: List[int]) -> int:
+        return await self._run(self.store.delete, document_ids)
+
+    async def close(self):
+        """
+        スレッドプールで実行中の処理を待ってからストアを閉じる
+        (待つ間もイベントループを止めないよう、どちらも既定のスレッドプールで実行する)
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, partial(self._executor.shutdown, wait=True))
+        await loop.run_in_executor(None, self.store.close)
+
 
 def create_vectorstore_from_markdown_directory(
     directory_path,
@@ -162,12 +1090,18 @@ def create_vectorstore_from_markdown_directory(
     chunk_size=1000,
     chunk_overlap=200,
     batch_size=100,
-    db_path="vectorstore.db"
+    max_batch_tokens=100000,
+    db_path="vectorstore.db",
+    embedding_cache_path="embedding_cache.db",
+    max_in_flight=None,
+    chunk_workers=4,
+    resume=True
 ):
     """ディレクトリ内の全マークダウンファイルからベクトルストアを作成"""
     from langchain.text_splitter import MarkdownTextSplitter
     
-    embedder = AzureOpenAIEmbedder(client=client)
+    cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None
+    embedder = AzureOpenAIEmbedder(client=client, cache=cache)
     vectorstore = SQLiteVectorStore(db_path)
 
     # テキストスプリッターの設定
@@ -176,38 +1110,40 @@ def create_vectorstore_from_markdown_directory(
         chunk_overlap=chunk_overlap
     )
 
-    markdown_files = read_markdown_files(directory_path)
-    
-    current_texts = []
-    current_metadatas = []
-    
-    for file_path, content in markdown_files:
-        chunks = text_splitter.split_text(content)
-        
-        for chunk in chunks:
-            current_texts.append(chunk)
-            current_metadatas.append({"source": file_path})
-            
-            if len(current_texts) >= batch_size:
-                try:
-                    embeddings = embedder.embed_documents(current_texts)
-                    vectorstore.add_vectors(embeddings, current_texts, current_metadatas)
-                    
-                    current_texts = []
-                    current_metadatas = []
-                    
-                except Exception as e:
-                    print(f"警告: バッチ処理中にエラーが発生しました: {e}")
-                    current_texts = []
-                    current_metadatas = []
-    
-    # 残りのテキストを処理
-    if current_texts:
-        try:
-            embeddings = embedder.embed_documents(current_texts)
-            vectorstore.add_vectors(embeddings, current_texts, current_metadatas)
-        except Exception as e:
-            print(f"警告: 最終バッチの処理中にエラーが発生しました: {e}")
+    def write(batch, embeddings):
+        vectorstore.add_vectors(embeddings, batch.texts, batch.metadatas, chunk_keys=batch.keys)
+
+    # 今回読んだファイルごとのsha256を記録し、取り込み後に変更前の内容や分割設定のチャンクを削除する
+    # (大きなファイルは複数の区切りに分けて読まれるため、1ファイルに複数のsha256がある)
+    digests = {}
+    digests_lock = threading.Lock()
+
+    def ingested(source, digest):
+        with digests_lock:
+            if not resume and source not in digests:
+                # resume=Falseの場合は、前回までに取り込んだこのファイルのチャンクを削除してから取り込み直す
+                # (区切りごとに呼ばれる大きなファイルも、削除は最初の1回だけ)
+                vectorstore.delete_stale_chunks({source: set()})
+            digests.setdefault(source, set()).add(digest)
+        # resume=Trueの場合は、前回までに取り込み済みのチャンクを飛ばして続きから取り込む
+        return vectorstore.ingested_chunks(source, digest) if resume else set()
+
+    stats = run_pipeline(
+        read_markdown_files(directory_path),
+        text_splitter.split_text,
+        embedder,
+        write,
+        batch_size=batch_size,
+        max_batch_tokens=max_batch_tokens,
+        ingested=ingested,
+        splitter_key=f"MarkdownTextSplitter({chunk_size}, {chunk_overlap})",
+        chunk_workers=chunk_workers,
+        max_in_flight=max_in_flight
+    )
+    print(stats.summary())
+    deleted = vectorstore.delete_stale_chunks(digests)
+    if deleted:
+        print(f"変更されたファイルの古いチャンクを{deleted}件削除しました")
 
     return vectorstore
 
@@ -0,0 +1,391 @@
+import json
+import os
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+STORE_FORMAT_VERSION = 1
+
+
+class _MappedRecords:
+    """オフセット配列で区切られたバイト列を、アクセス時にだけデコードする読み取り専用シーケンス"""
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, decode):
+        self._blob = blob
+        self._offsets = offsets
+        self._decode = decode
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start, end = int(self._offsets[idx]), int(self._offsets[idx + 1])
+        return self._decode(self._blob[start:end].tobytes())
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+def replace_atomically(write, path: str):
+    """一時ファイルに書き込んでから置き換える (読み込み中のmmapを壊さないため)"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def save_optional(path: str, write: Optional[Callable]):
+    """writeがあればファイルに書き出し、なければ以前に保存したファイルを削除する (作成していないインデックス用)"""
+    if write is not None:
+        replace_atomically(write, path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _save_records(blob_path: str, offsets_path: str, records, encode):
+    """レコードを連結したバイト列と、その開始位置のオフセット配列を保存"""
+    offsets = np.zeros(len(records) + 1, dtype=np.int64)
+
+    def write_blob(f):
+        for i, record in enumerate(records):
+            data = encode(record)
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+
+    replace_atomically(write_blob, blob_path)
+    replace_atomically(lambda f: np.save(f, offsets), offsets_path)
+
+
+def _load_records(blob_path: str, offsets_path: str, decode, mmap: bool):
+    """_save_recordsで保存したレコードを読み込む (mmap=Trueなら遅延デコード)"""
+    if not mmap:
+        offsets = np.load(offsets_path)
+        blob = np.fromfile(blob_path, dtype=np.uint8)
+        return list(_MappedRecords(blob, offsets, decode))
+
+    offsets = np.load(offsets_path, mmap_mode='r')
+    if os.path.getsize(blob_path) > 0:
+        blob = np.memmap(blob_path, dtype=np.uint8, mode='r')
+    else:
+        blob = np.empty(0, dtype=np.uint8)
+    return _MappedRecords(blob, offsets, decode)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """各行をL2ノルムで正規化 (ゼロベクトルはそのまま)"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """最後の軸に沿って上位k件のインデックスをスコア降順で返す (argpartitionで全体ソートを回避)"""
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.intp)
+    top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+def _encode_text(text: str) -> bytes:
+    return text.encode('utf-8')
+
+
+def _decode_text(data: bytes) -> str:
+    return data.decode('utf-8')
+
+
+def _encode_metadata(metadata: Dict) -> bytes:
+    return (json.dumps(metadata, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+class VectorStoreBase:
+    """
+    メモリ上のベクトルストアに共通する行の管理
+    正規化済みベクトルの行列 (倍々で事前確保)、行ごとのドキュメントIDと削除済みの印 (トゥームストーン)、
+    テキスト、メタデータを同じ行番号で持ち、追加・削除・compact・ディレクトリ形式での保存を行う
+    インデックスを持つサブクラスは _on_delete / _compact_indexes で行の削除・詰め直しに追従する
+    """
+    def __init__(self, initial_capacity: int = 1024, compaction_threshold: float = 0.3):
+        self._matrix = None      # 単位ベクトルに正規化した埋め込みベクトル (float32, 事前確保)
+        self._vectors_path = None  # 行列をディスク上に置く場合のファイル (keep_vectors_on_disk で指定)
+        self._spill_path = None    # mmapで読み込んだ行列に追加するとき、メモリ上へコピーせずに移すファイル
+        self._size = 0           # 格納済みのベクトル数 (削除済みの行を含む)
+        self._initial_capacity = initial_capacity
+        self._ids = None         # 行ごとのドキュメントID (int64, 昇順)
+        self._deleted = None     # 削除済みの行 (トゥームストーン)
+        self._n_deleted = 0
+        self._next_id = 0
+        # 削除済みの行がこの割合を超えたらcompactで詰め直す
+        self.compaction_threshold = compaction_threshold
+        self.texts = []          # 元のテキストを保存
+        self.metadatas = []      # メタデータを保存
+
+    @property
+    def vectors(self) -> np.ndarray:
+        """格納済みの正規化ベクトル (行数 = ドキュメント数) のビューを返す"""
+        if self._matrix is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self._matrix[:self._size]
+
+    def keep_vectors_on_disk(self, path: str):
+        """
+        行列をpathのファイル (float32の生データ) に移してmmapで参照し、以降の追加もファイルに書き込む
+        量子化インデックスと組み合わせると、メモリ上には量子化コードだけを持ち、
+        全精度の行は再スコアリングなどで読んだ部分だけがページインされる
+        """
+        matrix = self._matrix
+        if self._vectors_path == path and isinstance(matrix, np.memmap):
+            return
+        self._vectors_path = path
+        if matrix is None:
+            return
+        self._matrix = self._map_vectors(max(self._size, 1), matrix.shape[1], truncate=True)
+        for start in range(0, self._size, 65536):
+            self._matrix[start:start + 65536] = matrix[start:min(start + 65536, self._size)]
+
+    def _map_vectors(self, capacity: int, dim: int, truncate: bool = False) -> np.memmap:
+        """_vectors_pathのファイルをcapacity行に広げてmmapする (truncate=Falseなら既存の行はそのまま残る)"""
+        mode = 'r+b' if os.path.exists(self._vectors_path) and not truncate else 'w+b'
+        with open(self._vectors_path, mode) as f:
+            f.truncate(capacity * dim * np.dtype(np.float32).itemsize)
+        return np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+
+    def _reserve(self, n_new: int, dim: int):
+        """容量が足りなければ行列を倍々で拡張 (追加コストを償却O(1)に保つ)"""
+        if self._matrix is None or self._size == 0:
+            capacity = max(self._initial_capacity, n_new)
+            if self._vectors_path is not None:
+                self._matrix = self._map_vectors(capacity, dim, truncate=True)
+            else:
+                self._matrix = np.empty((capacity, dim), dtype=np.float32)
+            self._ids = np.empty(capacity, dtype=np.int64)
+            self._deleted = np.zeros(capacity, dtype=bool)
+            return
+
+        if dim != self._matrix.shape[1]:
+            raise ValueError(f"ベクトルの次元が一致しません: {dim} != {self._matrix.shape[1]}")
+
+        # mmapで読み込んだ行列は読み取り専用なので、最初の追加時にメモリ上へコピーする
+        # (_spill_pathがある場合はメモリ上へコピーせず、そのファイルに移してから追加する)
+        if not self._matrix.flags.writeable and self._spill_path is not None:
+            self.keep_vectors_on_disk(self._spill_path)
+        required = self._size + n_new
+        if required > min(self._matrix.shape[0], len(self._ids)) or not self._matrix.flags.writeable:
+            capacity = max(required, self._matrix.shape[0] * 2)
+            if self._vectors_path is not None:
+                # ファイルを広げてmmapし直すだけで、既存の行はコピーしない
+                self._matrix = self._map_vectors(capacity, dim)
+            else:
+                matrix = np.empty((capacity, dim), dtype=np.float32)
+                matrix[:self._size] = self._matrix[:self._size]
+                self._matrix = matrix
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:self._size] = self._ids[:self._size]
+            self._ids = ids
+            deleted = np.zeros(capacity, dtype=bool)
+            deleted[:self._size] = self._deleted[:self._size]
+            self._deleted = deleted
+
+    _normalize = staticmethod(normalize)
+    _top_k_indices = staticmethod(top_k_indices)
+
+    def _materialize(self):
+        """mmapで読み込んだテキストとメタデータを、追加・削除できるリストに変換"""
+        if not isinstance(self.texts, list):
+            self.texts = list(self.texts)
+        if not isinstance(self.metadatas, list):
+            self.metadatas = list(self.metadatas)
+
+    def _append_rows(
+        self,
+        vectors: Union[np.ndarray, List[List[float]]],
+        texts: List[str],
+        metadatas: List[Dict]
+    ) -> Tuple[int, np.ndarray]:
+        """
+        ベクトル、テキスト、メタデータを末尾の行に追加し、(追加した最初の行番号, 追加したID) を返す
+        vectorsがfloat32のndarrayの場合はコピーせず、正規化した結果を行列に直接書き込む
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or not (len(vectors) == len(texts) == len(metadatas)):
+            raise ValueError("vectors, texts, metadatas の件数が一致しません")
+
+        self._materialize()
+        self._reserve(len(vectors), vectors.shape[1])
+        start_row = self._size
+        # 正規化の結果を行列に直接書き込み、一時配列を作らない
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        np.divide(vectors, norms, out=self._matrix[start_row:start_row + len(vectors)])
+        ids = np.arange(self._next_id, self._next_id + len(vectors), dtype=np.int64)
+        self._ids[start_row:start_row + len(vectors)] = ids
+        self._deleted[start_row:start_row + len(vectors)] = False
+        self._next_id += len(vectors)
+        self._size += len(vectors)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+        return start_row, ids
+
+    def _document(self, idx: int) -> Dict:
+        """行番号から検索結果のドキュメントを作成"""
+        return {
+            "id": int(self._ids[idx]),
+            "page_content": self.texts[idx],
+            "metadata": self.metadatas[idx]
+        }
+
+    def _deleted_rows(self) -> Optional[np.ndarray]:
+        """削除済みの行を示すbool配列を返す (削除がなければNone)"""
+        return self._deleted[:self._size] if self._n_deleted else None
+
+    def delete(self, ids: List[int]) -> int:
+        """IDを指定してドキュメントを削除し、削除した件数を返す (存在しない・削除済みのIDは無視)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._size == 0 or len(ids) == 0:
+            return 0
+        # IDは追加順に振るため昇順に並んでおり、二分探索で行番号に変換できる
+        stored_ids = self._ids[:self._size]
+        rows = np.minimum(np.searchsorted(stored_ids, ids), self._size - 1)
+        return self._delete_rows(rows[stored_ids[rows] == ids])
+
+    def delete_where(self, predicate: Callable[[Dict], bool]) -> int:
+        """メタデータを受け取る関数がTrueを返すドキュメントを削除 (全件走査)"""
+        deleted = self._deleted_rows()
+        rows = [
+            row for row, metadata in enumerate(self.metadatas)
+            if (deleted is None or not deleted[row]) and predicate(metadata)
+        ]
+        return self._delete_rows(rows)
+
+    def _delete_rows(self, rows) -> int:
+        """
+        行に削除済みの印 (トゥームストーン) を付ける
+        行列やインデックスはその場では詰めず、削除済みの割合がcompaction_thresholdを超えたらcompactする
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if len(rows) == 0:
+            return 0
+        rows = rows[~self._deleted[rows]]
+        if len(rows) == 0:
+            return 0
+
+        self._deleted[rows] = True
+        self._n_deleted += len(rows)
+        self._on_delete(rows)
+        if self._n_deleted > self.compaction_threshold * self._size:
+            self.compact()
+        return len(rows)
+
+    def _on_delete(self, rows: np.ndarray):
+        """行に削除済みの印を付けた直後に呼ばれる (サブクラスで統計などを更新する)"""
+
+    def compact(self):
+        """削除済みの行を取り除いて行列・テキスト・メタデータ・各インデックスを詰め直す"""
+        if self._n_deleted == 0:
+            return
+        indices_to_keep = np.flatnonzero(~self._deleted[:self._size])
+
+        if self._vectors_path is not None:
+            # ディスク上の行列はその場で前に詰める (行番号は昇順なので、まだ読んでいない行は上書きしない)
+            for start in range(0, len(indices_to_keep), 65536):
+                rows = indices_to_keep[start:start + 65536]
+                self._matrix[start:start + len(rows)] = self._matrix[rows]
+        else:
+            self._matrix = self.vectors[indices_to_keep]
+        self._ids = self._ids[indices_to_keep]
+        self._deleted = np.zeros(len(indices_to_keep), dtype=bool)
+        self._n_deleted = 0
+        self._size = len(indices_to_keep)
+        self.texts = [self.texts[i] for i in indices_to_keep]
+        self.metadatas = [self.metadatas[i] for i in indices_to_keep]
+        self._compact_indexes(indices_to_keep)
+
+    def _compact_indexes(self, indices_to_keep: np.ndarray):
+        """compactで行を詰め直した後に呼ばれる (サブクラスでインデックスの行番号を付け替える)"""
+
+    def _save_rows(self, path: str):
+        """
+        行をディレクトリ形式で保存
+        vectors.npy (正規化済みfloat32行列), texts.bin + texts_offsets.npy,
+        metadatas.jsonl + metadatas_offsets.npy, ids.npy, deleted.npy を書き出す
+        """
+        os.makedirs(path, exist_ok=True)
+        vectors = np.ascontiguousarray(self.vectors)
+        replace_atomically(lambda f: np.save(f, vectors), os.path.join(path, "vectors.npy"))
+        _save_records(
+            os.path.join(path, "texts.bin"),
+            os.path.join(path, "texts_offsets.npy"),
+            self.texts,
+            _encode_text
+        )
+        _save_records(
+            os.path.join(path, "metadatas.jsonl"),
+            os.path.join(path, "metadatas_offsets.npy"),
+            self.metadatas,
+            _encode_metadata
+        )
+        ids = self._ids[:self._size] if self._size else np.empty(0, dtype=np.int64)
+        deleted = self._deleted[:self._size] if self._size else np.empty(0, dtype=bool)
+        replace_atomically(lambda f: np.save(f, ids), os.path.join(path, "ids.npy"))
+        replace_atomically(lambda f: np.save(f, deleted), os.path.join(path, "deleted.npy"))
+
+    def _save_info(self, path: str, **info):
+        """件数などにinfoを加えたstore.jsonを書き出す (インデックスを含むすべてのファイルの保存後に呼ぶ)"""
+        info = {
+            "format_version": STORE_FORMAT_VERSION,
+            "count": self._size,
+            "dimension": int(self._matrix.shape[1]) if self._size else 0,
+            "next_id": self._next_id,
+            **info,
+        }
+        replace_atomically(
+            lambda f: f.write(json.dumps(info, ensure_ascii=False, indent=2).encode('utf-8')),
+            os.path.join(path, "store.json")
+        )
+
+    def _load_rows(self, path: str, mmap: bool) -> Dict:
+        """
+        _save_rowsで保存した行を読み込み、store.jsonの内容を返す
+        mmap=Trueの場合、ベクトル・テキスト・メタデータはアクセスされた部分だけがページインされる
+        """
+        with open(os.path.join(path, "store.json"), 'r', encoding='utf-8') as f:
+            info = json.load(f)
+        if info.get("format_version") != STORE_FORMAT_VERSION:
+            raise ValueError(f"未対応の保存形式です: {info.get('format_version')}")
+
+        vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode='r' if mmap else None)
+        if len(vectors):
+            self._matrix = vectors
+            self._size = len(vectors)
+        # IDと削除済みの印は追加・削除で書き換えるため、常にメモリ上へ読み込む
+        ids_path = os.path.join(path, "ids.npy")
+        if os.path.exists(ids_path):
+            self._ids = np.load(ids_path)
+            self._deleted = np.load(os.path.join(path, "deleted.npy"))
+        else:
+            self._ids = np.arange(self._size, dtype=np.int64)
+            self._deleted = np.zeros(self._size, dtype=bool)
+        self._n_deleted = int(self._deleted.sum())
+        self._next_id = info.get("next_id", self._size)
+        self.texts = _load_records(
+            os.path.join(path, "texts.bin"),
+            os.path.join(path, "texts_offsets.npy"),
+            _decode_text,
+            mmap
+        )
+        self.metadatas = _load_records(
+            os.path.join(path, "metadatas.jsonl"),
+            os.path.join(path, "metadatas_offsets.npy"),
+            json.loads,
+            mmap
+        )
+        return info